@@ -27,7 +27,7 @@ mkdir -p $SHARED_DIR/artifacts/reporting/trustymail_reports
 # Generate agency reports
 # TODO? Separate cyhy reports from non-cyhy reports
 cd $SHARED_DIR/artifacts/reporting/trustymail_reports
-$HOME_DIR/report/create_all_reports.py
+$HOME_DIR/report/create_all_reports.py --workers=$(nproc)
 
 # Again, we let pshtt_reporter do the archiving.  If that container
 # isn't being used, though, then you'll want to uncomment the next
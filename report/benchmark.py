@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+'''Benchmark Trustworthy Email Agency Report generation on synthetic data.
+
+Generates a synthetic agency with trustymail and sslyze_scan documents shaped
+like the scan data, loads them into mongomock (or a scratch database on a
+local mongod), generates the agency's report at each size and times every
+stage.  Results are appended to a JSON Lines file and compared with the
+previous run of the same size and parameters, so that regressions show up
+from run to run.  The time it takes a fresh interpreter to import graphs is
+recorded too, and can be capped so that slow imports fail the benchmark.
+The synthetic data of each size is also checked against the vectorized
+scoring engine (see --check-scoring of generate_trustymail_report), so the
+benchmark fails if the two engines' counts differ on it.  The check runs
+apart from the timed report, as does the profiled report that --profile
+adds, so the recorded timings are those of a production run.  With
+--parity-only, only the check is run, without generating the reports.
+
+Requires xelatex, like the reports themselves, unless --parity-only.  mongomock evaluates queries
+in Python, so its fetch timings grow much faster than a real database's; use
+a local mongod (--mongo-uri) for the larger sizes.
+
+Usage:
+  benchmark [options]
+  benchmark (-h | --help)
+
+Options:
+  -b --subdomains-per-base=N     Number of subdomains of each base domain
+                                 [default: 4].
+  -H --smtp-hosts=N              Number of mail servers of each domain that
+                                 supports SMTP [default: 2].
+  -I --max-import-seconds=S      Fail if importing graphs takes longer than S
+                                 seconds.
+  -o --results=FILE              Append the results to the JSON Lines file FILE
+                                 [default: benchmark_results.jsonl].
+  -p --parity-only               Only check that the vectorized scoring
+                                 engine's counts equal the report's for each
+                                 size; nothing is typeset or recorded.
+  -P --profile                   Also generate each size's report with
+                                 profiling and record its profile (see
+                                 generate_trustymail_report --profile).
+  -r --seed=N                    Seed of the synthetic data [default: 0].
+  -s --sizes=SIZES               Comma-separated numbers of domains to benchmark
+                                 [default: 10,1000,10000,100000].
+  -t --smtp-fraction=F           Fraction of domains that support SMTP
+                                 [default: 0.6].
+  -u --mongo-uri=URI             Load the data into the scratch database
+                                 trustymail_report_benchmark at URI instead of
+                                 into mongomock.  Its collections are dropped.
+  -w --weak-crypto-fraction=F    Fraction of mail servers that support weak
+                                 crypto [default: 0.2].
+  -h --help                      Show this screen.
+'''
+# standard python libraries
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+# third-party libraries (install with pip)
+from docopt import docopt
+
+# intra-project modules
+from generate_trustymail_report import BOD1801_DMARC_RUA_URI, SSLYZE_SMTP_PORTS, ReportGenerator
+from metrics import MetricsSink
+
+# constants
+BENCHMARK_AGENCY = {'name':'Benchmark Agency', 'id':'BENCH'}
+BENCHMARK_DB_NAME = 'trustymail_report_benchmark'
+BENCHMARK_PARAMETERS = ('subdomains_per_base', 'smtp_hosts', 'smtp_fraction', 'weak_crypto_fraction', 'seed')
+IMPORT_BENCHMARK_MODULE = 'graphs'
+IMPORT_BENCHMARK_RUNS = 5       # the fastest run is recorded
+
+def synthetic_scan_data(size, subdomains_per_base, smtp_hosts, smtp_fraction, weak_crypto_fraction, seed):
+    '''Generate the latest trustymail and sslyze_scan documents of size domains
+    of BENCHMARK_AGENCY.
+
+    Every base domain has subdomains_per_base subdomains.  A domain supports
+    SMTP with probability smtp_fraction, in which case it has smtp_hosts mail
+    servers, each of which was scanned by sslyze and supports weak crypto with
+    probability weak_crypto_fraction.  The other attributes are drawn with
+    roughly the proportions of real scans.
+
+    Returns
+    -------
+    tuple: The list of trustymail documents and the list of sslyze_scan
+           documents.
+    '''
+    rnd = random.Random(seed)
+    scan_date = datetime.utcnow()
+    trustymail_docs = list()
+    sslyze_docs = list()
+    for base_index in range(int(math.ceil(size / float(subdomains_per_base + 1)))):
+        base_domain = 'benchmark-{}.gov'.format(base_index)
+        domains = [base_domain] + ['sub-{}.{}'.format(i, base_domain) for i in range(subdomains_per_base)]
+        for domain in domains[:size - len(trustymail_docs)]:
+            supports_smtp = rnd.random() < smtp_fraction
+            mail_servers = ['mx{}.{}'.format(i, domain) for i in range(smtp_hosts)] if supports_smtp else []
+            smtp_results = ', '.join('{}:{}'.format(host, port) for host in mail_servers for port in SSLYZE_SMTP_PORTS)
+            supports_starttls = supports_smtp and rnd.random() < 0.8
+            valid_dmarc = rnd.random() < 0.6
+            aggregate_report_uris = [{'uri':'mailto:dmarc@{}'.format(base_domain), 'modifier':None}]
+            if rnd.random() < 0.7:
+                aggregate_report_uris.append({'uri':BOD1801_DMARC_RUA_URI, 'modifier':None})
+            trustymail_docs.append({
+                'latest':True,
+                'agency':BENCHMARK_AGENCY,
+                'domain':domain,
+                'base_domain':base_domain,
+                'is_base_domain':domain == base_domain,
+                'live':rnd.random() < 0.8,
+                'scan_date':scan_date,
+                'mx_record':supports_smtp,
+                'mail_servers':', '.join(mail_servers),
+                'mail_server_ports_tested':', '.join(str(port) for port in SSLYZE_SMTP_PORTS),
+                'domain_supports_smtp':supports_smtp,
+                'domain_supports_smtp_results':smtp_results,
+                'domain_supports_starttls':supports_starttls,
+                'domain_supports_starttls_results':smtp_results if supports_starttls else '',
+                'spf_record':True,
+                'valid_spf':rnd.random() < 0.7,
+                'spf_results':'v=spf1 include:_spf.{} -all'.format(base_domain),
+                'dmarc_record':valid_dmarc,
+                'valid_dmarc':valid_dmarc,
+                'dmarc_results':'v=DMARC1; p=reject; rua=mailto:dmarc@{}'.format(base_domain) if valid_dmarc else '',
+                'dmarc_record_base_domain':valid_dmarc,
+                'valid_dmarc_base_domain':valid_dmarc,
+                'dmarc_results_base_domain':'',
+                'dmarc_policy':rnd.choice(('reject', 'reject', 'quarantine', 'none')),
+                'dmarc_policy_percentage':100,
+                'aggregate_report_uris':aggregate_report_uris,
+                'forensic_report_uris':[],
+                'has_aggregate_report_uri':True,
+                'has_forensic_report_uri':False,
+                'syntax_errors':[],
+                'debug_info':'',
+            })
+            for host in mail_servers:
+                weak_crypto = rnd.random() < weak_crypto_fraction
+                sslyze_docs.append({
+                    'latest':True,
+                    'agency':BENCHMARK_AGENCY,
+                    'domain':domain,
+                    'scanned_hostname':host,
+                    'scanned_port':25,
+                    'sslv2':False,
+                    'sslv3':weak_crypto,
+                    'any_3des':weak_crypto and rnd.random() < 0.5,
+                    'any_rc4':False,
+                })
+    return trustymail_docs, sslyze_docs
+
+def benchmark_db(mongo_uri=None):
+    '''Return an empty database to load the synthetic data into.'''
+    if mongo_uri:
+        from pymongo import MongoClient
+        db = MongoClient(mongo_uri)[BENCHMARK_DB_NAME]
+    else:
+        # not needed to generate reports, so not installed in the container
+        import mongomock
+        db = mongomock.MongoClient()[BENCHMARK_DB_NAME]
+    db.trustymail.drop()
+    db.sslyze_scan.drop()
+    return db
+
+def code_revision():
+    '''Return the git revision of the report code, or None.'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.realpath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def import_seconds(module):
+    '''Return the seconds it takes a fresh interpreter to import module, less
+    the seconds it takes to start one.'''
+    my_dir = os.path.dirname(os.path.realpath(__file__))
+    def fastest_run(code):
+        run_times = list()
+        for _ in range(IMPORT_BENCHMARK_RUNS):
+            start_time = time.time()
+            subprocess.check_call([sys.executable, '-c', code], cwd=my_dir)
+            run_times.append(time.time() - start_time)
+        return min(run_times)
+    return fastest_run('import ' + module) - fastest_run('pass')
+
+def result_key(record):
+    '''Return the key of the results that record is comparable with.'''
+    if record['record'] == 'import':
+        return ('import', record['module'])
+    return (record['size'],) + tuple(record['parameters'][p] for p in BENCHMARK_PARAMETERS)
+
+def previous_results(results_filename):
+    '''Return the last recorded result of each kind (see result_key).'''
+    results = dict()
+    if os.path.exists(results_filename):
+        with open(results_filename) as results_file:
+            for line in results_file:
+                record = json.loads(line)
+                results[result_key(record)] = record
+    return results
+
+def load_synthetic_data(db, size, parameters):
+    '''Replace the scan data in db with size synthetic domains.  Returns the
+    seconds it took to load them.'''
+    trustymail_docs, sslyze_docs = synthetic_scan_data(size, parameters['subdomains_per_base'], parameters['smtp_hosts'],
+                                                       parameters['smtp_fraction'], parameters['weak_crypto_fraction'],
+                                                       parameters['seed'])
+    db.trustymail.delete_many({})
+    db.sslyze_scan.delete_many({})
+    start_time = time.time()
+    db.trustymail.insert_many(trustymail_docs)
+    if sslyze_docs:
+        db.sslyze_scan.insert_many(sslyze_docs)
+    return time.time() - start_time
+
+def check_scoring_parity(db):
+    '''Fail unless the vectorized scoring engine's counts for the synthetic
+    domains in db equal those of the report's scoring.  Returns the counts.'''
+    with redirect_stdout(io.StringIO()):
+        generator = ReportGenerator(db, BENCHMARK_AGENCY['name'], check_scoring=True)
+        return generator.score()
+
+def generate_report(db, **report_options):
+    '''Generate the report of the synthetic domains in db in a temporary
+    directory, passing report_options to ReportGenerator.  Returns the
+    report's metrics record.'''
+    original_working_dir = os.getcwd()
+    temp_working_dir = tempfile.mkdtemp()
+    os.chdir(temp_working_dir)
+    try:
+        # the generator's progress output would drown out the results
+        with redirect_stdout(io.StringIO()):
+            generator = ReportGenerator(db, BENCHMARK_AGENCY['name'], **report_options)
+            generator.generate_trustymail_report()
+    finally:
+        os.chdir(original_working_dir)
+        shutil.rmtree(temp_working_dir)
+    return generator.metrics()
+
+def run_benchmark(db, size, parameters, profile=False):
+    '''Load size synthetic domains into db, check their scoring (see
+    check_scoring_parity) and time the generation of their report.  Returns
+    the report's metrics record, with the profile of a second, profiled
+    report if profile.'''
+    load_time = load_synthetic_data(db, size, parameters)
+    check_scoring_parity(db)
+    metrics = generate_report(db)
+    metrics['timings']['load'] = load_time
+    if profile:
+        metrics['profile'] = generate_report(db, profile=True)['profile']
+    return metrics
+
+def format_change(seconds, previous_seconds, previous_record):
+    if not previous_seconds:
+        return ''
+    return ' {:>+8.1f}% vs {}'.format((seconds / previous_seconds - 1) * 100,
+                                      previous_record['revision'] or previous_record['time'])
+
+def print_results(record, previous_record):
+    print('{} domains ({} scored):'.format(record['size'], record['counts']['all_eligible_domains_count']))
+    for stage, seconds in sorted(record['timings'].items(), key=lambda x:-x[1]):
+        previous_seconds = previous_record['timings'].get(stage) if previous_record else None
+        print('\t{:<16} {:>9.3f} s'.format(stage, seconds) + format_change(seconds, previous_seconds, previous_record))
+
+def main():
+    args = docopt(__doc__)
+    parameters = {'subdomains_per_base':int(args['--subdomains-per-base']),
+                  'smtp_hosts':int(args['--smtp-hosts']),
+                  'smtp_fraction':float(args['--smtp-fraction']),
+                  'weak_crypto_fraction':float(args['--weak-crypto-fraction']),
+                  'seed':int(args['--seed'])}
+    sizes = [int(size) for size in args['--sizes'].split(',')]
+    db = benchmark_db(args['--mongo-uri'])
+    if args['--parity-only']:
+        for size in sizes:
+            load_synthetic_data(db, size, parameters)
+            counts = check_scoring_parity(db)
+            print('{} domains ({} scored): vectorized scoring counts match'.format(size, counts['all_eligible_domains']))
+        sys.exit(0)
+
+    assert shutil.which('xelatex'), 'xelatex is required to generate reports'
+    revision = code_revision()
+    previous = previous_results(args['--results'])
+
+    results_sink = MetricsSink(args['--results'])
+    record = {'record':'import', 'time':datetime.utcnow().isoformat(), 'revision':revision,
+              'module':IMPORT_BENCHMARK_MODULE, 'seconds':import_seconds(IMPORT_BENCHMARK_MODULE)}
+    results_sink.write(record)
+    previous_record = previous.get(result_key(record))
+    print('import {}: {:.3f} s'.format(IMPORT_BENCHMARK_MODULE, record['seconds']) +
+          format_change(record['seconds'], previous_record and previous_record['seconds'], previous_record))
+    if args['--max-import-seconds']:
+        assert record['seconds'] <= float(args['--max-import-seconds']), \
+            'importing {} took longer than {} seconds'.format(IMPORT_BENCHMARK_MODULE, args['--max-import-seconds'])
+
+    for size in sizes:
+        metrics = run_benchmark(db, size, parameters, args['--profile'])
+        record = {'record':'benchmark', 'time':datetime.utcnow().isoformat(), 'revision':revision, 'size':size,
+                  'parameters':parameters, 'counts':metrics['counts'], 'timings':metrics['timings']}
+        if args['--profile']:
+            record['profile'] = metrics['profile']
+        results_sink.write(record)
+        print_results(record, previous.get(result_key(record)))
+    results_sink.close()
+    sys.exit(0)
+
+if __name__=='__main__':
+    main()
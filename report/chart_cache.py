@@ -0,0 +1,140 @@
+'''Persistent cache of rendered charts, shared between report runs and between
+the processes generating reports concurrently.
+
+The percentage charts of many agencies are identical (0%, 100%, the few
+fractions of agencies with a single domain), so rendered charts are stored
+as files named after a hash of everything they depend on: the chart's class
+and constructor arguments, graphs.STYLE_VERSION and the matplotlib version.
+Cached charts are hard-linked (or copied, across file systems) into a
+report's working directory.  Entries are evicted least recently used first
+once the cache holds more than max_bytes of them.'''
+
+# standard python libraries
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# third-party libraries (install with pip)
+import matplotlib
+
+# intra-project modules
+import graphs
+
+CHART_CACHE_EXTENSION = '.pdf'
+# fraction of max_bytes that eviction shrinks the cache to, so that it does
+# not rescan the cache for every chart added once it is full
+CHART_CACHE_EVICTION_TARGET = 0.9
+
+class ChartCache(object):
+    def __init__(self, cache_dir, max_bytes):
+        # absolute, as reports use the cache from their working directories
+        self.__cache_dir = os.path.abspath(cache_dir)
+        self.__max_bytes = max_bytes
+        os.makedirs(self.__cache_dir, exist_ok=True)
+        # other processes add charts too, so this is only an estimate until
+        # the next eviction rescans the cache
+        self.__cache_bytes = sum(size for _, _, size in self.__entries())
+
+    @staticmethod
+    def key(chart):
+        '''Return the key of chart, a graphs.MyTrustyBar or graphs.MyDonutPie.'''
+        inputs = {'class':type(chart).__name__, 'arguments':vars(chart),
+                  'style_version':graphs.STYLE_VERSION, 'matplotlib_version':matplotlib.__version__}
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def __filename(self, key):
+        return os.path.join(self.__cache_dir, key + CHART_CACHE_EXTENSION)
+
+    def __entries(self):
+        '''Yield the (filename, last used time, size) of each cached chart.'''
+        with os.scandir(self.__cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(CHART_CACHE_EXTENSION):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def get(self, chart, filename):
+        '''Link the cached rendering of chart to filename (without its .pdf
+        extension, as with chart.plot).  Returns whether it was cached.'''
+        cached_filename = self.__filename(self.key(chart))
+        dest_filename = filename + CHART_CACHE_EXTENSION
+        try:
+            os.link(cached_filename, dest_filename)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # e.g. the cache is on another file system
+            try:
+                shutil.copyfile(cached_filename, dest_filename)
+            except FileNotFoundError:
+                return False
+        try:
+            # the modification time records when the chart was last used
+            os.utime(cached_filename)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def put(self, chart, filename):
+        '''Cache the rendering of chart written to filename (without its .pdf
+        extension), then evict the least recently used charts if the cache is
+        over its size.'''
+        source_filename = filename + CHART_CACHE_EXTENSION
+        # cached files are replaced, never rewritten, so that the reports
+        # they are linked into are unaffected
+        temp_file, temp_filename = tempfile.mkstemp(dir=self.__cache_dir, suffix='.tmp')
+        os.close(temp_file)
+        try:
+            shutil.copy(source_filename, temp_filename)
+            os.replace(temp_filename, self.__filename(self.key(chart)))
+        except BaseException:
+            os.remove(temp_filename)
+            raise
+        self.__cache_bytes += os.path.getsize(source_filename)
+        if self.__cache_bytes > self.__max_bytes:
+            self.__evict()
+
+    def __evict(self):
+        entries = sorted(self.__entries(), key=lambda x:x[1])
+        self.__cache_bytes = sum(size for _, _, size in entries)
+        target_bytes = self.__max_bytes * CHART_CACHE_EVICTION_TARGET
+        for filename, _, size in entries:
+            if self.__cache_bytes <= target_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            self.__cache_bytes -= size
+
+class CachingChartEngine(object):
+    '''Wraps a chart engine (see graphs.TrustyChartEngine) so that charts
+    found in chart_cache are linked instead of plotted, and charts that are
+    plotted are added to chart_cache when the engine is flushed.'''
+    def __init__(self, chart_engine, chart_cache):
+        self.__chart_engine = chart_engine
+        self.__chart_cache = chart_cache
+        self.__plotted = list()     # (chart, filename) plotted since the last flush
+        self.hits = 0
+        self.misses = 0
+
+    def plot(self, chart, filename):
+        if self.__chart_cache.get(chart, filename):
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.__chart_engine.plot(chart, filename)
+            self.__plotted.append((chart, filename))
+
+    def flush(self):
+        self.__chart_engine.flush()
+        for chart, filename in self.__plotted:
+            self.__chart_cache.put(chart, filename)
+        self.__plotted = list()
@@ -1,17 +1,362 @@
 #!/usr/bin/env python3
 
-import os
+'''Create Trustworthy Email Agency Report PDFs for all agencies.
+
+Usage:
+  create_all_reports [options]
+  create_all_reports (-h | --help)
+
+Options:
+  -b --bulk-fetch                Fetch data for all agencies from the database
+                                 in one pass up front.
+  -c --score-cache=FILE          Cache domain scores across runs and agencies in
+                                 the SQLite database FILE.
+  --score-cache-size=N           Maximum number of domain scores to cache
+                                 [default: 1000000].
+  -C --chart-cache=DIR           Cache rendered charts across runs and agencies
+                                 in DIR and link them into the reports instead
+                                 of rendering them again.
+  --chart-cache-size=MB          Maximum size of the chart cache in megabytes
+                                 [default: 256].
+  -F --federal-summary           Create only the federal summary of all
+                                 agencies (see generate_federal_summary),
+                                 instead of the agency reports.
+  -f --latex-format-dir=DIR      Precompile the static LaTeX preamble into a
+                                 format file cached in DIR and reuse it.
+  -i --incremental               Reuse an agency's last report in the current
+                                 directory if none of its inputs have changed.
+  -j --emit-json                 Also write the data each report is rendered
+                                 from as JSON alongside its PDF.
+  -l --max-latex-passes=N        Maximum number of xelatex passes; passes stop
+                                 early once cross-references settle [default: 2].
+  -M --metrics=FILE              Append each report's counts, percentages and
+                                 stage timings, and the batch's, to the JSON
+                                 Lines file FILE.
+  --mongo-batch-size=N           Number of documents to fetch from the database
+                                 per round trip; 0 leaves it to the server
+                                 [default: 1000].
+  --mongo-pool-size=N            Maximum number of database connections of each
+                                 process, shared by its reports and prefetch
+                                 threads [default: 4].
+  -m --low-memory                Release domain documents once they are scored
+                                 and stream them again for CSV attachments.
+  -p --prefetch=N                Fetch the data of up to N agencies ahead in
+                                 background threads while reports are being
+                                 generated, holding the data of at most N + 1
+                                 agencies plus two per worker; it is ignored
+                                 with --bulk-fetch [default: 0].
+  --check-scoring                Fail reports whose counts differ from those of
+                                 the vectorized scoring engine.
+  -S --snapshot=DIR              Read the data of each agency from the snapshot
+                                 in DIR instead of from the database.
+  -x --export-snapshot=DIR       Export a snapshot of the data of all agencies
+                                 from the database to DIR, then generate the
+                                 reports from it.
+  -t --chart-backend=BACKEND     Render the charts as PDFs with matplotlib or
+                                 draw them in each report with tikz
+                                 [default: matplotlib].
+  -T --typesetters=N             Typeset the reports in N threads of the batch
+                                 process, which run xelatex while the workers
+                                 generate the next reports, up to 2N of which
+                                 wait to be typeset; 0 has each worker typeset
+                                 its own reports [default: 0].
+  -w --workers=N                 Number of worker processes [default: 1].
+  -s --summary=FILE              Write per-agency success/failure summary CSV
+                                 [default: create_all_reports_summary.csv].
+  -h --help                      Show this screen.
+'''
+# standard python libraries
 import csv
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# third-party libraries (install with pip)
+from docopt import docopt
+
+# intra-project modules
+from chart_cache import ChartCache
+from data_sources import MongoDataSource, SnapshotDataSource, export_snapshot
+from generate_federal_summary import FederalSummaryGenerator
+from generate_trustymail_report import (DB_CONFIG_FILE, ReportGenerator, cleanup_stale_work_dirs, db_from_config,
+                                        max_latex_passes_option, new_agency_data)
+from metrics import ConnectionPoolMetrics, MetricsSink
+from score_cache import ScoreCache
+from typesetting import TypesettingPool
 
 HOME_DIR = '/home/reporter'
 SHARED_DATA_DIR = HOME_DIR + '/shared/'
+SUMMARY_FIELDS = ('Agency', 'Status', 'Seconds', 'Error')
+
+# database connection owned by the current (worker) process, the metrics of
+# its connection pool and the process that connected; forked worker processes
+# inherit but must not use their parent's connection
+_db = None
+_pool_metrics = None
+_db_pid = None
+# keyword arguments for every ReportGenerator in the current process
+_report_options = dict()
+
+def process_db(pool_size):
+    '''Return the database connection of the current process, connecting with
+    a pool of up to pool_size connections the first time.  The pooled
+    MongoClient is shared by all of the process's reports and threads.'''
+    global _db, _pool_metrics, _db_pid
+    if _db_pid != os.getpid():
+        _pool_metrics = ConnectionPoolMetrics()
+        _db = db_from_config(DB_CONFIG_FILE, maxPoolSize=pool_size, event_listeners=[_pool_metrics])
+        _db_pid = os.getpid()
+    return _db
+
+def process_pool_metrics():
+    '''Return the connection pool metrics of the current process, or None if
+    it has not connected to the database.'''
+    return _pool_metrics if _db_pid == os.getpid() else None
+
+def process_data_source(mongo_options, snapshot_dir=None):
+    '''Return a data source for the current process: the snapshot in
+    snapshot_dir, if any, or else the process's database connection.
+    mongo_options holds the pool_size and batch_size of the connection.'''
+    if snapshot_dir:
+        return SnapshotDataSource(snapshot_dir)
+    return MongoDataSource(process_db(mongo_options['pool_size']), mongo_options['batch_size'])
+
+def init_worker(connect=True, report_options=None, score_cache_options=None, snapshot_dir=None, mongo_options=None):
+    '''Connect to the database once per worker process.  MongoClient is not
+    fork-safe, so this must run after the pool has forked.  Workers that are
+    handed bulk-fetched agency data do not need a connection, nor do workers
+    that read a snapshot.  Likewise, each worker opens its own connection to
+    the score cache, if any.'''
+    global _report_options
+    _report_options = dict(report_options or dict())
+    if connect or snapshot_dir:
+        _report_options['data_source'] = process_data_source(mongo_options, snapshot_dir)
+    if score_cache_options:
+        _report_options['score_cache'] = ScoreCache(**score_cache_options)
+
+def generate_agency_report(task):
+    '''Generate the report for a single agency in the current process and
+    return a summary row describing the outcome, along with the report's
+    metrics record (see ReportGenerator.metrics) and the job that typesets
+    it, if that is left to a typesetting pool.
+
+    task is an (agency, agency_data) tuple; agency_data is None unless the
+    agency's data was bulk-fetched or prefetched.'''
+    agency, agency_data = task
+    print('Generating Trustymail Report for {}...'.format(agency))
+    start_time = time.time()
+    status = 'success'
+    error = ''
+    generator = None
+    typesetting_job = None
+    try:
+        generator = ReportGenerator(_db, agency, agency_data=agency_data, **_report_options)
+        generator.generate_trustymail_report()
+        typesetting_job = generator.typesetting_job()
+    except SystemExit as e:
+        # ReportGenerator exits when an agency has no live domains
+        status = 'failure'
+        error = 'exited with status {}'.format(e.code)
+    except Exception as e:
+        status = 'failure'
+        error = '{}: {}'.format(type(e).__name__, e)
+        traceback.print_exc()
+    seconds = time.time() - start_time
+    metrics_record = generator.metrics() if generator else {'record':'report', 'agency':agency}
+    metrics_record.update(status=status, error=error, seconds=seconds)
+    pool_metrics = process_pool_metrics()
+    if pool_metrics:
+        # of the process so far, including any prefetching in it
+        metrics_record.update(pid=os.getpid(), connection_pool=pool_metrics.record())
+    return ({'Agency':agency, 'Status':status, 'Seconds':round(seconds, 1), 'Error':error},
+            metrics_record, typesetting_job)
+
+def add_typesetting_outcome(result, metrics_record, outcome):
+    '''Add the outcome of typesetting a report (see
+    typesetting.TypesettingPool.submit) to its summary row and metrics
+    record, whose seconds then include the typesetting.'''
+    metrics_record['timings'].update(outcome['timings'])
+    if 'profile' in metrics_record:
+        # typeset in a thread shared with other reports, so only the
+        # wall-clock seconds of its passes are its own
+        metrics_record['profile'].update((name, {'wall':seconds}) for name, seconds in outcome['timings'].items())
+    metrics_record['typesetting_seconds'] = outcome['seconds']
+    metrics_record['seconds'] += outcome['seconds']
+    result['Seconds'] = round(metrics_record['seconds'], 1)
+    if outcome['status'] != 'success':
+        result.update(Status=outcome['status'], Error=outcome['error'])
+        metrics_record.update(status=outcome['status'], error=outcome['error'])
+
+def bulk_fetched_tasks(agencies, all_agency_data):
+    '''Yield an (agency, agency_data) task for each agency, removing its data
+    from all_agency_data (see fetch_all_agency_data) as it goes, so that each
+    agency's data is freed once its report is done instead of at the end of
+    the batch.'''
+    for agency in agencies:
+        yield agency, all_agency_data.pop(agency, None) or new_agency_data()
+
+def throttled_tasks(tasks, in_flight):
+    '''Yield tasks, acquiring the semaphore in_flight before each one; the
+    caller releases it as each report is done.  pool.imap consumes tasks as
+    fast as they are yielded, so without it the workers would run arbitrarily
+    far ahead of the batch process: prefetch_agency_data would fetch every
+    agency's data at once, and reports would pile up waiting to be typeset.'''
+    for task in tasks:
+        in_flight.acquire()
+        yield task
+
+def prefetch_agency_data(agencies, depth, mongo_options, snapshot_dir=None):
+    '''Yield an (agency, agency_data) task for each agency, while the data of
+    up to depth agencies ahead is fetched by a pool of depth threads.  At most
+    depth + 1 agencies' data is held besides the tasks that have been taken
+    (one at a time by map, or see throttled_tasks).  If fetching an agency's
+    data fails, its task has no data, so that the report fetches it again and
+    records the failure.'''
+    # connect lazily, in case the caller forks worker processes first
+    data_source = process_data_source(mongo_options, snapshot_dir)
+
+    def prefetched_task(agency, future):
+        try:
+            return agency, future.result()
+        except Exception:
+            traceback.print_exc()
+            return agency, None
+
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending = deque()
+        for agency in agencies:
+            pending.append((agency, executor.submit(data_source.agency_data, agency)))
+            if len(pending) > depth:
+                yield prefetched_task(*pending.popleft())
+        while pending:
+            yield prefetched_task(*pending.popleft())
 
 def main():
-    agency_csv = open(SHARED_DATA_DIR + "artifacts/unique-agencies.csv")
+    args = docopt(__doc__)
+    workers = int(args['--workers'])
+    max_latex_passes = max_latex_passes_option(args['--max-latex-passes'])
+    start_time = time.time()
+
+    with open(SHARED_DATA_DIR + 'artifacts/unique-agencies.csv') as agency_csv:
+        agencies = [row[0] for row in sorted(csv.reader(agency_csv))]
+
+    if args['--federal-summary']:
+        print('Generating Trustymail Federal Summary...')
+        generator = FederalSummaryGenerator(db_from_config(DB_CONFIG_FILE), agencies=set(agencies))
+        generator.generate_federal_summary()
+        return
+
+    metrics_sink = MetricsSink(args['--metrics']) if args['--metrics'] else None
+
+    mongo_options = {'pool_size':int(args['--mongo-pool-size']), 'batch_size':int(args['--mongo-batch-size'])}
+    snapshot_dir = args['--snapshot']
+    if args['--export-snapshot']:
+        print('Exporting a snapshot of the data for all agencies...')
+        export_start_time = time.time()
+        manifest = export_snapshot(process_db(mongo_options['pool_size']), args['--export-snapshot'],
+                                   mongo_options['batch_size'])
+        if metrics_sink:
+            metrics_sink.write({'record':'export_snapshot', 'agency_count':len(manifest['agencies']),
+                                'seconds':time.time() - export_start_time})
+        snapshot_dir = args['--export-snapshot']
+
+    if args['--bulk-fetch']:
+        print('Fetching data for all agencies...')
+        fetch_start_time = time.time()
+        all_agency_data = process_data_source(mongo_options, snapshot_dir).all_agency_data()
+        if metrics_sink:
+            metrics_sink.write({'record':'bulk_fetch', 'agency_count':len(all_agency_data),
+                                'seconds':time.time() - fetch_start_time})
+        tasks = bulk_fetched_tasks(agencies, all_agency_data)
+        del all_agency_data
+    elif int(args['--prefetch']) > 0:
+        tasks = prefetch_agency_data(agencies, int(args['--prefetch']), mongo_options, snapshot_dir)
+    else:
+        tasks = [(agency, None) for agency in agencies]
+    connect = not (args['--bulk-fetch'] or snapshot_dir)
+    report_options = {'latex_format_dir':args['--latex-format-dir'],
+                      'max_latex_passes':max_latex_passes,
+                      'emit_json':args['--emit-json'],
+                      'low_memory':args['--low-memory'],
+                      'incremental':args['--incremental'],
+                      'check_scoring':args['--check-scoring'],
+                      'chart_backend':args['--chart-backend']}
+    if args['--chart-cache']:
+        # the cache is only a directory, so workers can share this instance
+        report_options['chart_cache'] = ChartCache(args['--chart-cache'], int(args['--chart-cache-size']) * 1024 * 1024)
+    typesetting_pool = None
+    if int(args['--typesetters']) > 0:
+        typesetting_pool = TypesettingPool(int(args['--typesetters']))
+        report_options['typesetting_dir'] = typesetting_pool.spool_dir
+    score_cache_options = None
+    if args['--score-cache']:
+        score_cache_options = {'filename':args['--score-cache'], 'max_entries':int(args['--score-cache-size'])}
+
+    # tasks yielded to the worker pool whose reports are not done yet
+    in_flight = None
+    if workers > 1 and (int(args['--prefetch']) > 0 or typesetting_pool):
+        # a task for each worker, and one waiting for it
+        in_flight = threading.BoundedSemaphore(2 * workers)
+        tasks = throttled_tasks(tasks, in_flight)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(connect, report_options, score_cache_options, snapshot_dir, mongo_options))
+        results = pool.imap(generate_agency_report, tasks)
+    else:
+        pool = None
+        init_worker(connect, report_options, score_cache_options, snapshot_dir, mongo_options)
+        results = map(generate_agency_report, tasks)
+
+    failure_count = 0
+    with open(args['--summary'], 'w') as summary_file:
+        summary_writer = csv.DictWriter(summary_file, SUMMARY_FIELDS)
+        summary_writer.writeheader()
+
+        def write_result(result, metrics_record, typesetting_future):
+            nonlocal failure_count
+            if typesetting_future:
+                add_typesetting_outcome(result, metrics_record, typesetting_future.result())
+            summary_writer.writerow(result)
+            summary_file.flush()
+            if metrics_sink:
+                metrics_sink.write(metrics_record)
+            if result['Status'] != 'success':
+                failure_count += 1
+
+        # results of the reports that may still be being typeset, written out
+        # in agency order once they are done
+        pending = deque()
+        for result, metrics_record, typesetting_job in results:
+            if in_flight:
+                in_flight.release()
+            typesetting_future = typesetting_pool.submit(typesetting_job) if typesetting_job else None
+            pending.append((result, metrics_record, typesetting_future))
+            while pending and (pending[0][2] is None or pending[0][2].done()):
+                write_result(*pending.popleft())
+        while pending:
+            write_result(*pending.popleft())
+        if typesetting_pool:
+            typesetting_pool.close()
+
+    if pool:
+        pool.close()
+        pool.join()
+        # the workers exit without removing their working directories
+        cleanup_stale_work_dirs()
+
+    if metrics_sink:
+        batch_record = {'record':'batch', 'agency_count':len(agencies), 'failure_count':failure_count,
+                        'workers':workers, 'seconds':time.time() - start_time}
+        pool_metrics = process_pool_metrics()
+        if pool_metrics:
+            batch_record['connection_pool'] = pool_metrics.record()
+        metrics_sink.write(batch_record)
+        metrics_sink.close()
 
-    for row in sorted(csv.reader(agency_csv)):
-        bashCommand = HOME_DIR + "/report/generate_trustymail_report.py " + '"' + row[0] + '"'
-        os.system(bashCommand)
+    print('Generated {} of {} agency reports'.format(len(agencies) - failure_count, len(agencies)))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,120 @@
+'''Sources of the scan data that reports are generated from.
+
+A data source provides the agency data slices that ReportGenerator consumes
+(see generate_trustymail_report.new_agency_data):
+
+  agency_data(agency): the data slice of one agency
+  all_agency_data(): a dict of the data slices of every agency, keyed by
+                     agency name
+  agency_domains(agency): an iterable of the agency's latest trustymail
+                          documents, sorted by domain
+
+MongoDataSource queries the database.  SnapshotDataSource reads a snapshot of
+the database exported once with export_snapshot, so that report workers can
+read their data locally and in parallel instead of querying the database that
+the scanners share.'''
+
+# standard python libraries
+import json
+import mmap
+import os
+from datetime import datetime
+
+# third-party libraries (install with pip)
+import bson
+from bson.codec_options import CodecOptions
+
+# intra-project modules
+from generate_trustymail_report import (add_agency_subdomains, fetch_agency_data, fetch_all_agency_data,
+                                        find_agency_domains, new_agency_data)
+
+# constants
+SNAPSHOT_MANIFEST_FILE = 'manifest.json'
+# the parts of an agency's data slice that are stored in their own file
+SNAPSHOT_SECTIONS = ('trustymail', 'other_subdomains', 'sslyze_scan')
+# decode datetimes the way db_from_config's MongoClient does
+SNAPSHOT_CODEC_OPTIONS = CodecOptions(tz_aware=True)
+
+class MongoDataSource(object):
+    '''Queries the database db, fetching batch_size documents per round trip
+    (0 leaves it to the server).  pymongo is thread-safe, so a MongoDataSource
+    can be shared by the threads of a process.'''
+    def __init__(self, db, batch_size=0):
+        self.__db = db
+        self.__batch_size = batch_size
+
+    def agency_data(self, agency):
+        return fetch_agency_data(self.__db, agency, self.__batch_size)
+
+    def all_agency_data(self):
+        return fetch_all_agency_data(self.__db, self.__batch_size)
+
+    def agency_domains(self, agency):
+        return find_agency_domains(self.__db, agency, self.__batch_size).sort('domain', 1)
+
+class SnapshotDataSource(object):
+    '''Reads the agency data slices in a snapshot directory written by
+    export_snapshot.  Each agency's data is stored as BSON files, which are
+    memory-mapped and decoded on demand.'''
+    def __init__(self, snapshot_dir):
+        # absolute, as the files are opened lazily, after reports chdir
+        self.__snapshot_dir = os.path.abspath(snapshot_dir)
+        with open(os.path.join(self.__snapshot_dir, SNAPSHOT_MANIFEST_FILE)) as manifest_file:
+            self.__manifest = json.load(manifest_file)
+
+    def __section_documents(self, agency, section):
+        '''Yield the documents of a section of agency's data slice.'''
+        agency_entry = self.__manifest['agencies'].get(agency)
+        if agency_entry is None:
+            return
+        filename = os.path.join(self.__snapshot_dir, '{}.{}.bson'.format(agency_entry['file_prefix'], section))
+        if os.path.getsize(filename) == 0:
+            # empty files cannot be memory-mapped
+            return
+        with open(filename, 'rb') as section_file:
+            with mmap.mmap(section_file.fileno(), 0, access=mmap.ACCESS_READ) as section_map:
+                yield from bson.decode_iter(section_map, SNAPSHOT_CODEC_OPTIONS)
+
+    def agency_data(self, agency):
+        agency_data = new_agency_data()
+        agency_data['trustymail'] = list(self.__section_documents(agency, 'trustymail'))
+        add_agency_subdomains(agency_data, self.__section_documents(agency, 'other_subdomains'))
+        agency_data['sslyze_scan'] = list(self.__section_documents(agency, 'sslyze_scan'))
+        return agency_data
+
+    def all_agency_data(self):
+        return {agency:self.agency_data(agency) for agency in self.__manifest['agencies']}
+
+    def agency_domains(self, agency):
+        # export_snapshot sorts them
+        return self.__section_documents(agency, 'trustymail')
+
+def export_snapshot(db, snapshot_dir, batch_size=0):
+    '''Export the data slices of every agency from the database to the
+    snapshot directory snapshot_dir, for SnapshotDataSource to read.  The
+    database is read in a single pass (see fetch_all_agency_data).'''
+    snapshot_dir = os.path.abspath(snapshot_dir)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    try:
+        # the previous snapshot is unreadable until this one is complete
+        os.remove(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_FILE))
+    except FileNotFoundError:
+        pass
+    manifest = {'created':datetime.utcnow().isoformat(), 'agencies':dict()}
+    for agency_index, (agency, agency_data) in enumerate(sorted(fetch_all_agency_data(db, batch_size).items())):
+        file_prefix = 'agency-{:05d}'.format(agency_index)
+        # the agency's own subdomains are part of its trustymail documents
+        sections = {'trustymail':sorted(agency_data['trustymail'], key=lambda x:x['domain']),
+                    'other_subdomains':[d for subdomains in agency_data['subdomains'].values() for d in subdomains
+                                        if d['agency']['name'] != agency],
+                    'sslyze_scan':agency_data['sslyze_scan']}
+        for section in SNAPSHOT_SECTIONS:
+            with open(os.path.join(snapshot_dir, '{}.{}.bson'.format(file_prefix, section)), 'wb') as section_file:
+                for doc in sections[section]:
+                    section_file.write(bson.encode(doc))
+        manifest['agencies'][agency] = {'file_prefix':file_prefix,
+                                        'counts':{section:len(sections[section]) for section in SNAPSHOT_SECTIONS}}
+    # written last, so that an incomplete snapshot cannot be read
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return manifest
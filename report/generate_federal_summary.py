@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+'''Create Trustworthy Email Federal Summary PDF and CSV.
+
+Computes the BOD 18-01 email metrics of every agency in a single streamed
+pass over the latest scan data, without generating any agency reports.
+
+Usage:
+  generate_federal_summary [options]
+  generate_federal_summary (-h | --help)
+
+Options:
+  -d --debug                     Keep intermediate files for debugging.
+  -q --parquet                   Also write the summary as Parquet (requires
+                                 pyarrow or fastparquet).
+  -h --help                      Show this screen.
+'''
+# standard python libraries
+import codecs
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+# third-party libraries (install with pip)
+import pandas as pd
+import pystache
+from docopt import docopt
+
+# intra-project modules
+import graphs
+import vectorized_scoring
+from generate_trustymail_report import (BOD1801_DMARC_RUA_URI, DB_CONFIG_FILE, LATEX_ESCAPE_TABLE, SSLYZE_PROJECTION,
+                                        SSLYZE_SMTP_PORTS, db_from_config, plot_score_charts, process_work_dir,
+                                        setup_work_directory, typeset_latex)
+from metrics import StageTimer
+from percentages import PERCENTAGE_DENOMINATORS, score_percentages
+
+# constants
+FEDERAL_SUMMARY_MUSTACHE_FILE = 'federal_summary.mustache'
+FEDERAL_SUMMARY_PDF = 'federal_summary.pdf'
+FEDERAL_SUMMARY_TEX = 'federal_summary.tex'
+FEDERAL_SUMMARY_MAX_LATEX_PASSES = 2
+FEDERAL_SUMMARY_CSV_HEADER_FIELDS = ('Agency', 'Agency ID', 'Live Hostnames', 'Base Domains and SMTP Subdomains', 'Valid DMARC', 'Valid DMARC %', 'DMARC p=reject', 'DMARC p=reject %', 'Reports DMARC to DHS', 'Reports DMARC to DHS %', 'Supports STARTTLS', 'Supports STARTTLS %', 'Valid SPF', 'Valid SPF %', 'No Weak Crypto', 'No Weak Crypto %', 'BOD 18-01 Compliant', 'BOD 18-01 Compliant %')
+FEDERAL_SUMMARY_CSV_DATA_FIELDS = ('agency', 'agency_id', 'all_eligible_domains_count', 'base_domain_plus_smtp_subdomain_count', 'valid_dmarc_count', 'valid_dmarc_percentage', 'valid_dmarc_reject_count', 'valid_dmarc_reject_percentage', 'valid_dmarc_bod1801_rua_uri_count', 'valid_dmarc_bod1801_rua_uri_percentage', 'supports_starttls_count', 'supports_starttls_percentage', 'valid_spf_count', 'valid_spf_percentage', 'has_no_weak_crypto_count', 'has_no_weak_crypto_percentage', 'bod_1801_compliant_count', 'bod_1801_compliant_percentage')
+FEDERAL_SUMMARY_TRUSTYMAIL_PROJECTION = {field:1 for field in vectorized_scoring.DOMAIN_FRAME_FIELDS}
+FEDERAL_SUMMARY_TRUSTYMAIL_PROJECTION['_id'] = 0
+
+class FederalSummaryGenerator(object):
+    def __init__(self, db, agencies=None, debug=False, parquet=False):
+        self.__db = db
+        self.__debug = debug
+        self.__parquet = parquet
+        self.__generated_time = datetime.utcnow()
+
+        # Score the domains of all agencies at once, then keep the agencies
+        # that would get a report (those with live domains)
+        base_domains, self.__agency_ids = fetch_federal_base_domains(self.__db, agencies)
+        frame = vectorized_scoring.domain_frame(base_domains, BOD1801_DMARC_RUA_URI)
+        del base_domains
+        agency_counts = vectorized_scoring.agency_score_counts(frame)
+        self.__agency_counts = agency_counts[agency_counts['all_eligible_domains'] > 0]
+        self.__federal_counts = {name:int(count) for name, count in self.__agency_counts.sum().items()}
+
+    def generate_federal_summary(self):
+        print('\tparsing data')
+        summary_rows = [self.__summary_row(agency, counts) for agency, counts in self.__agency_counts.iterrows()]
+        summary_frame = pd.DataFrame(summary_rows, columns=FEDERAL_SUMMARY_CSV_DATA_FIELDS)
+        federal_row = self.__summary_row('Federal Government', self.__federal_counts)
+
+        datestamp = self.__generated_time.strftime('%Y-%m-%d')
+        dest_basename = 'cyhy-federal-{}-tmail-summary'.format(datestamp)
+        summary_frame.to_csv(dest_basename + '.csv', header=FEDERAL_SUMMARY_CSV_HEADER_FIELDS, index=False)
+        if self.__parquet:
+            summary_frame.to_parquet(dest_basename + '.parquet', index=False)
+
+        # create a working directory
+        original_working_dir = os.getcwd()
+        if self.__debug:
+            temp_working_dir = tempfile.mkdtemp(dir=original_working_dir)
+        else:
+            temp_working_dir = process_work_dir()
+        os.chdir(temp_working_dir)
+
+        try:
+            # setup the working directory
+            self.__setup_work_directory(temp_working_dir)
+
+            print('\tgenerating charts')
+            self.__generate_charts(federal_row)
+
+            self.__generate_latex(summary_rows, federal_row)
+
+            print('\tassembling PDF')
+            self.__generate_final_pdf()
+        finally:
+            # revert working directory
+            os.chdir(original_working_dir)
+
+        if not self.__debug:
+            src_filename = os.path.join(temp_working_dir, FEDERAL_SUMMARY_PDF)
+            shutil.move(src_filename, dest_basename + '.pdf')
+
+    def __summary_row(self, agency, counts):
+        # plain ints, so that the percentages are rounded like the reports'
+        counts = {name:int(count) for name, count in counts.items()}
+        row = {'agency':agency, 'agency_id':self.__agency_ids.get(agency, '')}
+        for name in ('all_eligible_domains', 'base_domain_plus_smtp_subdomain'):
+            row[name + '_count'] = counts[name]
+        for name, percentage in score_percentages(counts).items():
+            row[name + '_count'] = counts[name]
+            row[name + '_percentage'] = percentage
+        return row
+
+    def __setup_work_directory(self, work_dir):
+        setup_work_directory(work_dir)
+
+    ###############################################################################
+    #  Chart Generation
+    ###############################################################################
+    def __generate_charts(self, federal_row):
+        chart_engine = graphs.trusty_chart_engine()
+        plot_score_charts(chart_engine, {name:federal_row[name + '_percentage']
+                                         for name in PERCENTAGE_DENOMINATORS})
+        chart_engine.flush()
+
+    ###############################################################################
+    # Final Document Generation and Assembly
+    ###############################################################################
+    def __generate_latex(self, summary_rows, federal_row):
+        data = dict(federal_row)
+        data['agency_count'] = len(summary_rows)
+        data['agencies'] = [dict(row, agency=row['agency'].translate(LATEX_ESCAPE_TABLE),
+                                 agency_id=row['agency_id'].translate(LATEX_ESCAPE_TABLE))
+                            for row in summary_rows]
+        data['title_date_tex'] = self.__generated_time.strftime('{%d}{%m}{%Y}')
+
+        my_dir = os.path.dirname(os.path.realpath(__file__))
+        with codecs.open(os.path.join(my_dir, FEDERAL_SUMMARY_MUSTACHE_FILE), 'r', encoding='utf-8') as mustache_file:
+            template = mustache_file.read()
+        r = pystache.render(template, data)
+        with codecs.open(FEDERAL_SUMMARY_TEX, 'w', encoding='utf-8') as output:
+            output.write(r)
+
+    def __generate_final_pdf(self):
+        with open(os.devnull, 'w') as devnull:
+            output = sys.stdout if self.__debug else devnull
+            # the summary is typeset once per run, so a precompiled format
+            # would not be reused; the second pass resolves the table of
+            # contents and longtable widths
+            typeset_latex(None, FEDERAL_SUMMARY_MAX_LATEX_PASSES, output, dict(), StageTimer(),
+                          tex_filename=FEDERAL_SUMMARY_TEX)
+
+###############################################################################
+#  Data Retrieval
+###############################################################################
+def fetch_federal_base_domains(db, agencies=None):
+    '''Fetch the base domains of all agencies (or only those in agencies) with
+    their subdomains and weak crypto data, streaming each collection once.
+
+    Only the fields needed to score the domains with vectorized_scoring are
+    fetched.  As in the agency reports, a domain only has weak crypto if its
+    base domain's agency scanned a host of it that supports weak crypto.
+
+    Returns
+    -------
+    tuple: The list of base domain documents and a dict of agency IDs keyed
+           by agency name.
+    '''
+    weak_crypto_domains = set()     # (agency name, domain)
+    for host in db.sslyze_scan.find({'latest':True, 'scanned_port':{'$in':SSLYZE_SMTP_PORTS}}, SSLYZE_PROJECTION):
+        if host['sslv2'] or host['sslv3'] or host['any_3des'] or host['any_rc4']:
+            weak_crypto_domains.add((host['agency']['name'], host['domain']))
+
+    base_domains = list()
+    subdomains_by_base_domain = dict()
+    agency_ids = dict()
+    for domain_doc in db.trustymail.find({'latest':True}, FEDERAL_SUMMARY_TRUSTYMAIL_PROJECTION):
+        if domain_doc['is_base_domain']:
+            if agencies is None or domain_doc['agency']['name'] in agencies:
+                base_domains.append(domain_doc)
+                agency_ids[domain_doc['agency']['name']] = domain_doc['agency']['id']
+        else:
+            subdomains_by_base_domain.setdefault(domain_doc['base_domain'], []).append(domain_doc)
+
+    for domain_doc in base_domains:
+        agency = domain_doc['agency']['name']
+        domain_doc['domain_has_weak_crypto'] = (agency, domain_doc['domain']) in weak_crypto_domains
+        domain_doc['subdomains'] = subdomains_by_base_domain.get(domain_doc['base_domain'], [])
+        for subdomain_doc in domain_doc['subdomains']:
+            subdomain_doc['domain_has_weak_crypto'] = (agency, subdomain_doc['domain']) in weak_crypto_domains
+    return base_domains, agency_ids
+
+def main():
+    args = docopt(__doc__)
+    db = db_from_config(DB_CONFIG_FILE)
+
+    print('Generating Trustymail Federal Summary...')
+    generator = FederalSummaryGenerator(db, debug=args['--debug'], parquet=args['--parquet'])
+    generator.generate_federal_summary()
+    print('Done')
+    sys.exit(0)
+
+if __name__=='__main__':
+    main()
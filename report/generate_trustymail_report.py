@@ -8,74 +8,189 @@ Usage:
   generate_trustymail_report --version
 
 Options:
+  -c --score-cache=FILE          Cache domain scores across runs in the SQLite
+                                 database FILE.
+  --score-cache-size=N           Maximum number of domain scores to cache
+                                 [default: 1000000].
+  -C --chart-cache=DIR           Cache rendered charts across runs in DIR and
+                                 link them into the report instead of
+                                 rendering them again.
+  --chart-cache-size=MB          Maximum size of the chart cache in megabytes
+                                 [default: 256].
   -d --debug                     Keep intermediate files for debugging.
+  -f --latex-format-dir=DIR      Precompile the static LaTeX preamble into a
+                                 format file cached in DIR and reuse it.
+  -i --incremental               Reuse the last report generated in the current
+                                 directory if none of its inputs have changed.
+  -j --emit-json                 Also write the data the report is rendered
+                                 from as JSON alongside the PDF.
+  -l --max-latex-passes=N        Maximum number of xelatex passes; passes stop
+                                 early once cross-references settle [default: 2].
+  -M --metrics=FILE              Append the report's counts, percentages and
+                                 stage timings to the JSON Lines file FILE.
+  -m --low-memory                Release domain documents once they are scored
+                                 and stream them again for the CSV attachment.
+  -P --profile                   Record the wall-clock and CPU seconds of each
+                                 stage and the peak RSS so far, and print them
+                                 when done; in debug mode they are also written
+                                 to the working directory.
+  --profile-dir=DIR              With --profile, also profile each stage with
+                                 cProfile and dump its stats to DIR.
+  --profile-memory               With --profile, also trace the memory each
+                                 stage allocates at its peak.  Tracing slows
+                                 the stages down several times over, so take
+                                 timings from a run without it.
+  -p --check-projection          Fail if the report uses a trustymail field that
+                                 is not fetched from the database.
+  --check-scoring                Fail if the counts of the vectorized scoring
+                                 engine differ from the report's.
+  -t --chart-backend=BACKEND     Render the charts as PDFs with matplotlib or
+                                 draw them in the report with tikz
+                                 [default: matplotlib].
   -h --help                      Show this screen.
   --version                      Show version.
 '''
 # standard python libraries
+import atexit
 import codecs
 import csv
+import glob
+import hashlib
 import json
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
 from datetime import datetime
 
 # third-party libraries (install with pip)
 import pystache
 from bson import ObjectId
-from docopt import docopt
+from docopt import DocoptExit, docopt
 from pymongo import MongoClient
 import yaml
 
 # intra-project modules
+from chart_cache import CachingChartEngine, ChartCache
 import graphs
+from metrics import MetricsSink, StageProfiler, StageTimer
+from percentages import score_percentages
+from score_cache import ScoreCache
 
 # constants
 DB_CONFIG_FILE = '/run/secrets/scan_read_creds.yml'
 TRUSTYMAIL_RESULTS_CSV_FILE = 'trustymail_results.csv'
+TRUSTYMAIL_RESULTS_CSV_BUFFER_SIZE = 1024 * 1024     # bytes
 MUSTACHE_FILE = 'trustymail_report.mustache'
 REPORT_JSON = 'trustymail_report.json'
 REPORT_PDF = 'trustymail_report.pdf'
+REPORT_PROFILE = 'profile.txt'
 REPORT_TEX = 'trustymail_report.tex'
+REPORT_JOBNAME = 'trustymail_report'
 ASSETS_DIR_SRC = '../assets'
 ASSETS_DIR_DST = 'assets'
-LATEX_ESCAPE_MAP = {
-    '$':'\\$',
-    '%':'\\%',
-    '&':'\\&',
-    '#':'\\#',
-    '_':'\\_',
-    '{':'\\{',
-    '}':'\\}',
-    '[':'{[}',
-    ']':'{]}',
-    "'":"{'}",
-    '\\':'\\textbackslash{}',
-    '~':'\\textasciitilde{}',
-    '<':'\\textless{}',
-    '>':'\\textgreater{}',
-    '^':'\\textasciicircum{}',
-    '`':'{}`',
-    '\n': '\\newline{}',
-}
+# working directories are named WORK_DIR_PREFIX<pid>-..., see process_work_dir()
+WORK_DIR_PREFIX = 'trustymail-report-'
+# RAM-backed file systems to create working directories on, if available
+TMPFS_DIRS = ('/dev/shm',)
+CHART_BACKENDS = ('matplotlib', 'tikz')
+# files (relative to this one) whose content determines a report's output
+# along with its data: the template and every project module the report
+# imports, see report_inputs_fingerprint()
+REPORT_CODE_FILES = ('chart_cache.py', 'generate_trustymail_report.py', 'graphs.py', 'metrics.py', 'percentages.py',
+                     'score_cache.py', 'vectorized_scoring.py', MUSTACHE_FILE)
+# directories (relative to this one) of static files that the report is
+# typeset with, see report_inputs_fingerprint()
+REPORT_INPUT_DIRS = (ASSETS_DIR_SRC, '../fonts')
+# the charts escape their text with the same map, see graphs.TikzChartEngine
+LATEX_ESCAPE_TABLE = str.maketrans(graphs.LATEX_ESCAPE_MAP)
+LATEX_SPECIAL_CHARACTERS = frozenset(graphs.LATEX_ESCAPE_MAP)
+LATEX_REFERENCE_EXTENSIONS = ('.aux', '.toc', '.out')
+LATEX_END_OF_DUMP = '\\csname endofdump\\endcsname'
+LATEX_FORMAT_PREFIX = 'trustymail_report_preamble-'
+LATEX_FORMAT_MAX_AGE = 24 * 60 * 60     # seconds until unused formats are pruned
 BOD1801_DMARC_RUA_URI = 'mailto:reports@dmarc.cyber.dhs.gov'
+SCORING_RULES_VERSION = 1   # increment whenever __score_live_domain changes
+SCORE_COUNTS = ('eligible_domains', 'all_eligible_domains', 'base_domain_supports_smtp', 'eligible_subdomains', 'valid_dmarc', 'valid_dmarc_reject', 'valid_dmarc_bod1801_rua_uri', 'mx_record', 'domain_supports_smtp', 'base_domain_plus_smtp_subdomain', 'valid_spf', 'has_no_weak_crypto', 'supports_starttls', 'bod_1801_compliant')
+TRUSTYMAIL_RESULTS_CSV_HEADER_FIELDS = ('Domain', 'Base Domain', 'Domain Is Base Domain', 'Live', 'MX Record', 'Mail Servers', 'Mail Server Ports Tested', 'Domain Supports SMTP', 'Domain Supports SMTP Results', 'Domain Supports STARTTLS', 'Domain Supports STARTTLS Results', 'SPF Record', 'Valid SPF', 'SPF Results', 'DMARC Record', 'Valid DMARC', 'DMARC Results', 'DMARC Record on Base Domain', 'Valid DMARC Record on Base Domain', 'DMARC Results on Base Domain', 'DMARC Policy', 'DMARC Policy Percentage', 'DMARC Aggregate Report URIs', 'DMARC Forensic Report URIs', 'DMARC Has Aggregate Report URI', 'DMARC Has Forensic Report URI', 'Syntax Errors', 'Debug Info', 'Domain Supports Weak Crypto', 'Mail-Sending Hosts with Weak Crypto')
+TRUSTYMAIL_RESULTS_CSV_DATA_FIELDS = ('domain', 'base_domain', 'is_base_domain', 'live', 'mx_record', 'mail_servers', 'mail_server_ports_tested', 'domain_supports_smtp', 'domain_supports_smtp_results', 'domain_supports_starttls', 'domain_supports_starttls_results', 'spf_record', 'valid_spf', 'spf_results', 'dmarc_record', 'valid_dmarc', 'dmarc_results', 'dmarc_record_base_domain', 'valid_dmarc_base_domain', 'dmarc_results_base_domain', 'dmarc_policy', 'dmarc_policy_percentage', 'aggregate_report_uris', 'forensic_report_uris', 'has_aggregate_report_uri', 'has_forensic_report_uri', 'syntax_errors', 'debug_info', 'domain_has_weak_crypto', 'hosts_with_weak_crypto_str')
+# trustymail fields read while scoring domains
+TRUSTYMAIL_SCORING_FIELDS = ('agency', 'domain', 'base_domain', 'is_base_domain', 'live', 'mx_record', 'mail_servers', 'domain_supports_smtp', 'domain_supports_smtp_results', 'domain_supports_starttls', 'domain_supports_starttls_results', 'spf_record', 'valid_spf', 'spf_results', 'dmarc_record', 'valid_dmarc', 'valid_dmarc_base_domain', 'dmarc_results', 'dmarc_policy', 'aggregate_report_uris', 'scan_date')
+# fields that ReportGenerator adds to trustymail documents itself
+TRUSTYMAIL_COMPUTED_FIELDS = ('subdomains', 'domain_has_weak_crypto', 'hosts_with_weak_crypto', 'hosts_with_weak_crypto_str')
+# the only trustymail fields fetched from the database
+TRUSTYMAIL_PROJECTION = {field:1 for field in TRUSTYMAIL_SCORING_FIELDS + TRUSTYMAIL_RESULTS_CSV_DATA_FIELDS if field not in TRUSTYMAIL_COMPUTED_FIELDS}
+TRUSTYMAIL_PROJECTION['_id'] = 0
+SSLYZE_SMTP_PORTS = [25, 587, 465]
+SSLYZE_PROJECTION = {'_id':0, 'agency.name':1, 'domain':1, 'scanned_port':1, 'scanned_hostname':1, 'sslv2':1, 'sslv3':1, 'any_3des':1, 'any_rc4':1}
+
+class ProjectedDocument(dict):
+    '''A trustymail document that fails loudly when a field outside of
+    TRUSTYMAIL_PROJECTION (or the fields ReportGenerator computes itself) is
+    accessed, since such a field would silently be missing from the report.'''
+    allowed_fields = frozenset(TRUSTYMAIL_PROJECTION).union(TRUSTYMAIL_COMPUTED_FIELDS)
+
+    def __check_field(self, field):
+        if field not in self.allowed_fields:
+            raise KeyError('trustymail field "{}" is not in TRUSTYMAIL_PROJECTION'.format(field))
+
+    def __getitem__(self, field):
+        self.__check_field(field)
+        return dict.__getitem__(self, field)
+
+    def __contains__(self, field):
+        self.__check_field(field)
+        return dict.__contains__(self, field)
+
+    def get(self, field, default=None):
+        self.__check_field(field)
+        return dict.get(self, field, default)
 
 class ReportGenerator(object):
     #initiate variables
-    def __init__(self, db, agency, debug=False):
+    def __init__(self, db, agency, debug=False, agency_data=None, check_projection=False, latex_format_dir=None,
+                 max_latex_passes=2, emit_json=False, low_memory=False, incremental=False, score_cache=None,
+                 check_scoring=False, profile=False, profile_dir=None, profile_memory=False, data_source=None,
+                 chart_backend='matplotlib', chart_cache=None, typesetting_dir=None):
+        assert chart_backend in CHART_BACKENDS, 'Unknown chart backend: {}'.format(chart_backend)
+        assert max_latex_passes >= 1, 'max_latex_passes must be at least 1, not {}'.format(max_latex_passes)
         self.__db = db
+        self.__data_source = data_source    # see data_sources; None to query db directly
         self.__agency = agency
         self.__agency_id = None
         self.__debug = debug
+        self.__emit_json = emit_json
+        self.__low_memory = low_memory
+        self.__check_projection = check_projection
+        self.__incremental = incremental
+        self.__fingerprint = None
+        self.__score_cache = score_cache    # a score_cache.ScoreCache
+        self.__check_scoring = check_scoring
+        self.__chart_backend = chart_backend
+        self.__chart_pictures = dict()      # chart name: TikZ picture, with the tikz backend
+        self.__chart_cache = chart_cache    # a chart_cache.ChartCache; unused with the tikz backend
+        self.__chart_cache_counts = None    # hits and misses of chart_cache
+        self.__score_counts = dict.fromkeys(SCORE_COUNTS, 0)  # accumulated by __score_domain
+        self.__profile = profile
+        if profile:
+            self.__timer = StageProfiler(profile_dir, trace_memory=profile_memory)
+        else:
+            self.__timer = StageTimer()
+        self.__reused_report = False
+        self.__typesetting_dir = typesetting_dir    # see typesetting.TypesettingPool.spool_dir
+        self.__typesetting_job = None
+        self.__latex_format_dir = latex_format_dir
+        self.__max_latex_passes = max_latex_passes
         self.__generated_time = datetime.utcnow()
         self.__results = dict() # reusable query results
         self.__requests = None
         self.__report_doc = {'scores':[]}
-        self.__all_domains = []
+        self.__all_domains = []               # empty in low_memory mode
         self.__base_domains = []
+        self.__trustymail_data = None         # caller-fetched trustymail documents
+        self.__sslyze_data_all_domains = dict()
         self.__eligible_domains_count = 0     # responsive second-level/base-domains
         self.__eligible_subdomains_count = 0  # responsive subdomains
         self.__all_eligible_domains_count = 0 # responsive base+subs
@@ -96,16 +211,24 @@ class ReportGenerator(object):
         self.__bod_1801_compliant_count = 0
         #self.__report_oid = ObjectId()     # For future use
 
-        # Get list of all domains from the database
-        all_domains_cursor = self.__db.trustymail.find({'latest':True, 'agency.name': agency})
-        self.__domain_count = all_domains_cursor.count()
-
-        # Get weak crypto data for this agency's domains from the sslyze-scan collection
-        # TODO: Consider using aggregation $lookup with uncorrelated subquery to fetch
-        #       trustymail and sslyze_scan data in one query (MongoDB server 3.6 and later)
-
-        sslyze_data_all_domains = dict()
-        for host in self.__db.sslyze_scan.find({'latest':True, 'agency.name':agency, 'scanned_port': {'$in':[25, 587, 465]}}, {'_id':0, 'domain':1, 'scanned_port':1, 'scanned_hostname':1, 'sslv2':1, 'sslv3':1, 'any_3des':1, 'any_rc4':1}):
+        # Get all data for this agency from the database (or the data source),
+        # unless the caller already fetched it (see fetch_all_agency_data)
+        if agency_data is None:
+            with self.__timer.stage('fetch'):
+                if self.__data_source is not None:
+                    agency_data = self.__data_source.agency_data(agency)
+                else:
+                    agency_data = fetch_agency_data(self.__db, agency)
+        else:
+            self.__trustymail_data = agency_data['trustymail']
+        self.__domain_count = len(agency_data['trustymail'])
+        if incremental:
+            # before any weak crypto data is added to the documents
+            self.__fingerprint = agency_data_fingerprint(agency_data)
+
+        # Index weak crypto data for this agency's domains from the sslyze-scan collection
+        sslyze_data_all_domains = self.__sslyze_data_all_domains
+        for host in agency_data['sslyze_scan']:
             current_host_dict = {'scanned_hostname':host['scanned_hostname'], 'scanned_port':host['scanned_port'],
                                  'sslv2':host['sslv2'], 'sslv3':host['sslv3'],
                                  'any_3des':host['any_3des'], 'any_rc4':host['any_rc4']}
@@ -118,145 +241,176 @@ class ReportGenerator(object):
         def add_weak_crypto_data_to_domain(domain_doc, sslyze_data_all_domains):
             # Look for weak crypto data in sslyze_data_all_domains and add
             # hosts with weak crypto to domain_doc['hosts_with_weak_crypto']
-            domain_doc['domain_has_weak_crypto'] = False
-            domain_doc['hosts_with_weak_crypto'] = []
-
-            if sslyze_data_all_domains.get(domain_doc['domain']):
-                for host in sslyze_data_all_domains[domain_doc['domain']]:
-                    if host['sslv2'] or host['sslv3'] or host['any_3des'] or host['any_rc4']:
-                        domain_doc['domain_has_weak_crypto'] = True
-                        domain_doc['hosts_with_weak_crypto'].append(host)
+            domain_doc['hosts_with_weak_crypto'] = self.__hosts_with_weak_crypto(domain_doc['domain'])
+            domain_doc['domain_has_weak_crypto'] = bool(domain_doc['hosts_with_weak_crypto'])
             return domain_doc
 
-        for domain_doc in all_domains_cursor:
+        for domain_doc in agency_data['trustymail']:
+            if check_projection:
+                domain_doc = ProjectedDocument(domain_doc)
             domain_doc = add_weak_crypto_data_to_domain(domain_doc, sslyze_data_all_domains)
-            self.__all_domains.append(domain_doc)
+            if not low_memory:
+                self.__all_domains.append(domain_doc)
             if domain_doc['is_base_domain']:
-                domain_doc['subdomains'] = list(self.__db.trustymail.find({'latest':True, 'base_domain':domain_doc['base_domain'], 'is_base_domain':False}).sort([('domain', 1)]))
+                domain_doc['subdomains'] = agency_data['subdomains'].get(domain_doc['base_domain'], [])
+                if check_projection:
+                    domain_doc['subdomains'] = [ProjectedDocument(d) for d in domain_doc['subdomains']]
                 self.__subdomain_count += len(domain_doc['subdomains'])
                 for subdomain_doc in domain_doc['subdomains']:
                     subdomain_doc = add_weak_crypto_data_to_domain(subdomain_doc, sslyze_data_all_domains)
                 self.__base_domains.append(domain_doc)
+                # Count the second-level domains an agency owns
+                self.__base_domain_count += 1
             self.__agency_id = domain_doc['agency']['id']
 
-        # Get count of second-level domains an agency owns
-        self.__base_domain_count = self.__db.trustymail.find({'latest':True, 'agency.name': agency, 'is_base_domain':True}).count()
+    def __hosts_with_weak_crypto(self, domain_name):
+        '''Return the sslyze data of domain_name's hosts that support weak crypto.'''
+        return [host for host in self.__sslyze_data_all_domains.get(domain_name, [])
+                if host['sslv2'] or host['sslv3'] or host['any_3des'] or host['any_rc4']]
 
-    def __score_domain(self, domain):
+    def __score_live_domain(self, domain):
+        '''Score a live domain, not including its subdomains.  Returns the
+        score and the amounts to add to each of the report's counts; neither
+        depends on anything but the domain document.'''
         score = {'subdomain_scores': list(), 'live': domain['live'], 'has_live_smtp_subdomains': False}
-        if domain['live']:
-            # Check if the current domain is the base domian.
-            if domain['is_base_domain']:
-                self.__eligible_domains_count += 1
-                self.__all_eligible_domains_count += 1
-
-                # Count the base domains that support SMTP
-                if domain['domain_supports_smtp']:
-                    self.__base_domain_supports_smtp_count += 1
-            else:
-                self.__eligible_subdomains_count += 1
-                self.__all_eligible_domains_count += 1
+        counts = dict.fromkeys(SCORE_COUNTS, 0)
+        # Check if the current domain is the base domian.
+        if domain['is_base_domain']:
+            counts['eligible_domains'] += 1
+            counts['all_eligible_domains'] += 1
+
+            # Count the base domains that support SMTP
+            if domain['domain_supports_smtp']:
+                counts['base_domain_supports_smtp'] += 1
+        else:
+            counts['eligible_subdomains'] += 1
+            counts['all_eligible_domains'] += 1
 
-            score['domain'] = domain['domain']
+        # String values are LaTeX-escaped as they enter the score
+        score['domain'] = self.__latex_escape(domain['domain'])
 
-            # Does the given domain have a DMARC record
-            score['dmarc_record'] = domain['dmarc_record']
+        # Does the given domain have a DMARC record
+        score['dmarc_record'] = domain['dmarc_record']
 
-            # Is the DMARC record syntactically and logically correct,
-            # either at the domain or its base domain
-            score['valid_dmarc'] = domain['valid_dmarc'] or domain['valid_dmarc_base_domain']
-            if score['valid_dmarc']:
-                self.__valid_dmarc_count += 1
+        # Is the DMARC record syntactically and logically correct,
+        # either at the domain or its base domain
+        score['valid_dmarc'] = domain['valid_dmarc'] or domain['valid_dmarc_base_domain']
+        if score['valid_dmarc']:
+            counts['valid_dmarc'] += 1
 
-            # Placeholder for future use in reports.
-            if domain['dmarc_results'] is None or len(domain['dmarc_results']) == 0:
-                score['dmarc_results'] = "None"
-            else:
-                score['dmarc_results'] = domain['dmarc_results']
-
-            # dmarc_policy is adjudicated by trustymail, but it doesn't factor
-            # in whether or not the DMARC record is valid, so we check here
-            score['dmarc_policy'] = domain['dmarc_policy']
-            score['valid_dmarc_policy_reject'] = False
-            if score['valid_dmarc'] and domain['dmarc_policy'] == "reject":
-                self.__valid_dmarc_reject_count += 1
-                score['valid_dmarc_policy_reject'] = True
-
-            # Does the domain have a valid DMARC record that includes
-            # the correct BOD 18-01 rua URI
-            score['valid_dmarc_bod1801_rua_uri'] = False
-            if score['valid_dmarc']:
-                for uri_dict in domain['aggregate_report_uris']:
-                    if uri_dict['uri'] == BOD1801_DMARC_RUA_URI:
-                        self.__valid_dmarc_bod1801_rua_uri_count += 1
-                        score['valid_dmarc_bod1801_rua_uri'] = True
-                        break
-
-            # If the server has any valid MX record it is considered as sending mail
-            score['mx_record'] = domain['mx_record']
-            if domain['mx_record']:
-                self.__mx_record_count += 1
-
-            # Probably not used in the report for now, but go ahead and include it.
-            if domain['mail_servers'] is None or len(domain['mail_servers']) == 0:
-                score['mail_servers'] = "None"
-            else:
-                score['mail_servers'] = domain['mail_servers']
+        # Placeholder for future use in reports.
+        if domain['dmarc_results'] is None or len(domain['dmarc_results']) == 0:
+            score['dmarc_results'] = "None"
+        else:
+            score['dmarc_results'] = self.__latex_escape(domain['dmarc_results'])
+
+        # dmarc_policy is adjudicated by trustymail, but it doesn't factor
+        # in whether or not the DMARC record is valid, so we check here
+        score['dmarc_policy'] = self.__latex_escape(domain['dmarc_policy'])
+        score['valid_dmarc_policy_reject'] = False
+        if score['valid_dmarc'] and domain['dmarc_policy'] == "reject":
+            counts['valid_dmarc_reject'] += 1
+            score['valid_dmarc_policy_reject'] = True
+
+        # Does the domain have a valid DMARC record that includes
+        # the correct BOD 18-01 rua URI
+        score['valid_dmarc_bod1801_rua_uri'] = False
+        if score['valid_dmarc']:
+            for uri_dict in domain['aggregate_report_uris']:
+                if uri_dict['uri'] == BOD1801_DMARC_RUA_URI:
+                    counts['valid_dmarc_bod1801_rua_uri'] += 1
+                    score['valid_dmarc_bod1801_rua_uri'] = True
+                    break
+
+        # If the server has any valid MX record it is considered as sending mail
+        score['mx_record'] = domain['mx_record']
+        if domain['mx_record']:
+            counts['mx_record'] += 1
+
+        # Probably not used in the report for now, but go ahead and include it.
+        if domain['mail_servers'] is None or len(domain['mail_servers']) == 0:
+            score['mail_servers'] = "None"
+        else:
+            score['mail_servers'] = self.__latex_escape(domain['mail_servers'])
 
-            # Does the given domain have a SPF record
-            score['spf_record'] = domain['spf_record']
+        # Does the given domain have a SPF record
+        score['spf_record'] = domain['spf_record']
 
-            # Is the record syntactically and logically correct
-            score['valid_spf'] = domain['valid_spf']
+        # Is the record syntactically and logically correct
+        score['valid_spf'] = domain['valid_spf']
 
-            # Placeholder for future use in reports.
-            if domain['spf_results'] is None or len(domain['spf_results']) == 0:
-                score['spf_results'] = "None"
-            else:
-                score['spf_results'] = domain['spf_results']
+        # Placeholder for future use in reports.
+        if domain['spf_results'] is None or len(domain['spf_results']) == 0:
+            score['spf_results'] = "None"
+        else:
+            score['spf_results'] = self.__latex_escape(domain['spf_results'])
+
+        # Does the domain support SMTP?
+        score['domain_supports_smtp'] = domain['domain_supports_smtp']
+        score['smtp_servers'] = list()
+        if domain['domain_supports_smtp']:
+            score['smtp_servers'] = [s.strip() for s in domain['domain_supports_smtp_results'].split(',')]
+            counts['domain_supports_smtp'] += 1
+
+        # Does the domain support STARTTLS?
+        score['domain_supports_starttls'] = domain['domain_supports_starttls']
+        if not domain['domain_supports_starttls']:
+            starttls_servers = [s.strip() for s in domain['domain_supports_starttls_results'].split(',')]
+            score['smtp_servers_without_starttls'] = list(set(score['smtp_servers']) - set(starttls_servers))
+
+        # Does the domain have weak crypto?
+        score['domain_has_weak_crypto'] = domain['domain_has_weak_crypto']
+        score['hosts_with_weak_crypto'] = list()
+        for host in domain['hosts_with_weak_crypto']:
+            weak_crypto_list = list()
+            for (wc_key, wc_text) in [('sslv2','SSLv2'), ('sslv3','SSLv3'), ('any_3des','3DES'), ('any_rc4','RC4')]:
+                if host[wc_key]:
+                    weak_crypto_list.append(wc_text)
+            score['hosts_with_weak_crypto'].append({'hostname':self.__latex_escape(host['scanned_hostname']),
+                                                    'port':self.__latex_escape(host['scanned_port']),
+                                                    'weak_crypto_list_str':','.join(weak_crypto_list)})
+
+        score['bod_1801_compliant'] = False
+        # For SPF, STARTTLS, Weak Crypto and BOD 18-01 Compliance, we only count base domains and subdomains that support SMTP
+        if domain['is_base_domain'] or (not domain['is_base_domain'] and domain['domain_supports_smtp']):
+            counts['base_domain_plus_smtp_subdomain'] += 1
+            if domain['valid_spf']:
+                counts['valid_spf'] += 1
+            if not domain['domain_has_weak_crypto']:
+                counts['has_no_weak_crypto'] += 1
+            if ((domain['domain_supports_smtp'] and domain['domain_supports_starttls']) or not domain['domain_supports_smtp']):
+                counts['supports_starttls'] += 1   # If you don't support SMTP, you still get credit here for supporting STARTTLS
+                # Is the domain compliant with BOD 18-01?
+                #  * Uses STARTTLS on all SMTP servers OR does not support SMTP
+                #  * Has valid SPF Record
+                #  * Has no weak crypto (SSLv2, SSLv3, 3DES, RC4)
+                #  * Has valid DMARC record with p=reject and rua=mailto:reports@dmarc.cyber.dhs.gov
+                if domain['valid_spf'] and not domain['domain_has_weak_crypto'] and score['valid_dmarc_policy_reject'] and score['valid_dmarc_bod1801_rua_uri']:
+                    score['bod_1801_compliant'] = True
+                    counts['bod_1801_compliant'] += 1
+        return score, counts
+
+    def __cached_live_domain_score(self, domain):
+        '''Return __score_live_domain(domain), from the score cache if possible.
+        A domain document is identified by its domain and scan date, and its
+        score also depends on the weak crypto data and the scoring rules.'''
+        if self.__score_cache is None or domain.get('scan_date') is None:
+            return self.__score_live_domain(domain)
+        weak_crypto = json.dumps(domain['hosts_with_weak_crypto'], sort_keys=True, default=str)
+        key = json.dumps([domain['domain'], str(domain['scan_date']),
+                          hashlib.sha1(weak_crypto.encode('utf-8')).hexdigest(), SCORING_RULES_VERSION])
+        cached = self.__score_cache.get(key)
+        if cached is not None:
+            return cached
+        score, counts = self.__score_live_domain(domain)
+        self.__score_cache.put(key, [score, counts])
+        return score, counts
 
-            # Does the domain support SMTP?
-            score['domain_supports_smtp'] = domain['domain_supports_smtp']
-            score['smtp_servers'] = list()
-            if domain['domain_supports_smtp']:
-                score['smtp_servers'] = [s.strip() for s in domain['domain_supports_smtp_results'].split(',')]
-                self.__domain_supports_smtp_count += 1
-
-            # Does the domain support STARTTLS?
-            score['domain_supports_starttls'] = domain['domain_supports_starttls']
-            if not domain['domain_supports_starttls']:
-                starttls_servers = [s.strip() for s in domain['domain_supports_starttls_results'].split(',')]
-                score['smtp_servers_without_starttls'] = list(set(score['smtp_servers']) - set(starttls_servers))
-
-            # Does the domain have weak crypto?
-            score['domain_has_weak_crypto'] = domain['domain_has_weak_crypto']
-            score['hosts_with_weak_crypto'] = list()
-            for host in domain['hosts_with_weak_crypto']:
-                weak_crypto_list = list()
-                for (wc_key, wc_text) in [('sslv2','SSLv2'), ('sslv3','SSLv3'), ('any_3des','3DES'), ('any_rc4','RC4')]:
-                    if host[wc_key]:
-                        weak_crypto_list.append(wc_text)
-                score['hosts_with_weak_crypto'].append({'hostname':host['scanned_hostname'], 'port':host['scanned_port'],
-                                                        'weak_crypto_list_str':','.join(weak_crypto_list)})
-
-            score['bod_1801_compliant'] = False
-            # For SPF, STARTTLS, Weak Crypto and BOD 18-01 Compliance, we only count base domains and subdomains that support SMTP
-            if domain['is_base_domain'] or (not domain['is_base_domain'] and domain['domain_supports_smtp']):
-                self.__base_domain_plus_smtp_subdomain_count += 1
-                if domain['valid_spf']:
-                    self.__valid_spf_count += 1
-                if not domain['domain_has_weak_crypto']:
-                    self.__has_no_weak_crypto_count += 1
-                if ((domain['domain_supports_smtp'] and domain['domain_supports_starttls']) or not domain['domain_supports_smtp']):
-                    self.__supports_starttls_count += 1   # If you don't support SMTP, you still get credit here for supporting STARTTLS
-                    # Is the domain compliant with BOD 18-01?
-                    #  * Uses STARTTLS on all SMTP servers OR does not support SMTP
-                    #  * Has valid SPF Record
-                    #  * Has no weak crypto (SSLv2, SSLv3, 3DES, RC4)
-                    #  * Has valid DMARC record with p=reject and rua=mailto:reports@dmarc.cyber.dhs.gov
-                    if domain['valid_spf'] and not domain['domain_has_weak_crypto'] and score['valid_dmarc_policy_reject'] and score['valid_dmarc_bod1801_rua_uri']:
-                        score['bod_1801_compliant'] = True
-                        self.__bod_1801_compliant_count += 1
+    def __score_domain(self, domain):
+        if domain['live']:
+            score, counts = self.__cached_live_domain_score(domain)
+            for name in SCORE_COUNTS:
+                self.__score_counts[name] += counts[name]
 
             if domain.get('subdomains'):    # if this domain has any subdomains
                 for subdomain in domain['subdomains']:
@@ -269,6 +423,7 @@ class ReportGenerator(object):
             return score
 
         else:   # domain['live'] == "False"
+            score = {'subdomain_scores': list(), 'live': domain['live'], 'has_live_smtp_subdomains': False}
             # Check if any subdomains of non-live domains support SMTP; if so, we want to include them in our results, per CYHY-554)
             if domain.get('subdomains'):    # if this domain has any subdomains
                 for subdomain in domain['subdomains']:
@@ -297,111 +452,261 @@ class ReportGenerator(object):
             if score:
                 self.__report_doc['scores'].append(score)    # Add domain's score to master list of scores
 
-        if not self.__all_eligible_domains_count:
+        if not self.__score_counts['all_eligible_domains']:
             #TODO Decide if we want to generate an empty report in this case
             print('ERROR: "{}" has no live domains - exiting without generating report!'.format(self.__agency))
             sys.exit(-1)
 
-        self.__supports_starttls_percentage = round((((self.__supports_starttls_count)/float(self.__base_domain_plus_smtp_subdomain_count)) * 100), 1)
-        self.__valid_spf_percentage = round((((self.__valid_spf_count)/float(self.__base_domain_plus_smtp_subdomain_count)) * 100), 1)
-        self.__has_no_weak_crypto_percentage = round((((self.__has_no_weak_crypto_count)/float(self.__base_domain_plus_smtp_subdomain_count)) * 100), 1)
-        self.__valid_dmarc_percentage = round((((self.__valid_dmarc_count)/float(self.__all_eligible_domains_count)) * 100), 1)
-        self.__valid_dmarc_reject_percentage = round((((self.__valid_dmarc_reject_count)/float(self.__all_eligible_domains_count)) * 100), 1)
-        self.__valid_dmarc_bod1801_rua_uri_percentage = round((((self.__valid_dmarc_bod1801_rua_uri_count)/float(self.__all_eligible_domains_count)) * 100), 1)
-        self.__bod_1801_compliant_percentage = round((((self.__bod_1801_compliant_count)/float(self.__base_domain_plus_smtp_subdomain_count)) * 100), 1)
-
-        # print('Agency,Base Domains,Found Subdomains,Live,Valid SPF Record,Valid DMARC Record,Base Domain DMARC Reject,All Domains DMARC Reject Count,All Domains DMARC Reject Percentage)
-        print(self.__agency_id, self.__agency, self.__base_domain_count, self.__subdomain_count, self.__all_eligible_domains_count, self.__valid_spf_count, self.__valid_dmarc_count, self.__valid_dmarc_reject_count, self.__valid_dmarc_reject_percentage)
+        counts = self.__score_counts
+        self.__eligible_domains_count = counts['eligible_domains']
+        self.__all_eligible_domains_count = counts['all_eligible_domains']
+        self.__base_domain_supports_smtp_count = counts['base_domain_supports_smtp']
+        self.__eligible_subdomains_count = counts['eligible_subdomains']
+        self.__valid_dmarc_count = counts['valid_dmarc']
+        self.__valid_dmarc_reject_count = counts['valid_dmarc_reject']
+        self.__valid_dmarc_bod1801_rua_uri_count = counts['valid_dmarc_bod1801_rua_uri']
+        self.__mx_record_count = counts['mx_record']
+        self.__domain_supports_smtp_count = counts['domain_supports_smtp']
+        self.__base_domain_plus_smtp_subdomain_count = counts['base_domain_plus_smtp_subdomain']
+        self.__valid_spf_count = counts['valid_spf']
+        self.__has_no_weak_crypto_count = counts['has_no_weak_crypto']
+        self.__supports_starttls_count = counts['supports_starttls']
+        self.__bod_1801_compliant_count = counts['bod_1801_compliant']
+
+        percentages = score_percentages(counts)
+        self.__percentages = percentages
+        self.__supports_starttls_percentage = percentages['supports_starttls']
+        self.__valid_spf_percentage = percentages['valid_spf']
+        self.__has_no_weak_crypto_percentage = percentages['has_no_weak_crypto']
+        self.__valid_dmarc_percentage = percentages['valid_dmarc']
+        self.__valid_dmarc_reject_percentage = percentages['valid_dmarc_reject']
+        self.__valid_dmarc_bod1801_rua_uri_percentage = percentages['valid_dmarc_bod1801_rua_uri']
+        self.__bod_1801_compliant_percentage = percentages['bod_1801_compliant']
+
+    def __check_score_counts(self):
+        '''Fail if the vectorized scoring engine's counts for the report's
+        domains differ from the counts of __score_domain.'''
+        # imported here so that reports that are not checked do not load pandas
+        import vectorized_scoring
+        frame = vectorized_scoring.domain_frame(self.__base_domains, BOD1801_DMARC_RUA_URI)
+        vectorized_counts = vectorized_scoring.score_counts(frame)
+        assert vectorized_counts == self.__score_counts, \
+            'vectorized scoring counts {} differ from {}'.format(vectorized_counts, self.__score_counts)
 
     def __latex_escape(self, to_escape):
-        return ''.join([LATEX_ESCAPE_MAP.get(i,i) for i in to_escape])
-
-    def __latex_escape_structure(self, data):
-        '''assumes that all sequences contain dicts'''
-        if isinstance(data, dict):
-            for k,v in data.items():
-                if k.endswith('_tex'): # skip special tex values
-                    continue
-                if isinstance(v, str):
-                    data[k] = self.__latex_escape(v)
-                else:
-                    self.__latex_escape_structure(v)
-        elif isinstance(data, (list, tuple)):
-            for i in data:
-                self.__latex_escape_structure(i)
+        '''Escape to_escape if it is a string; other values are returned as-is.'''
+        if isinstance(to_escape, str) and not LATEX_SPECIAL_CHARACTERS.isdisjoint(to_escape):
+            return to_escape.translate(LATEX_ESCAPE_TABLE)
+        return to_escape
+
+    def metrics(self):
+        '''Return a metrics record (see metrics.MetricsSink) of the report's
+        counts, percentages and the seconds spent in each stage so far.'''
+        counts = {'domain_count':self.__domain_count, 'base_domain_count':self.__base_domain_count,
+                  'subdomain_count':self.__subdomain_count}
+        counts.update((name + '_count', count) for name, count in self.__score_counts.items())
+        percentages = dict()
+        if self.__all_eligible_domains_count:
+            percentages = {'valid_dmarc':self.__valid_dmarc_percentage,
+                           'valid_dmarc_reject':self.__valid_dmarc_reject_percentage,
+                           'valid_dmarc_bod1801_rua_uri':self.__valid_dmarc_bod1801_rua_uri_percentage,
+                           'supports_starttls':self.__supports_starttls_percentage,
+                           'valid_spf':self.__valid_spf_percentage,
+                           'has_no_weak_crypto':self.__has_no_weak_crypto_percentage,
+                           'bod_1801_compliant':self.__bod_1801_compliant_percentage}
+        record = {'record':'report', 'agency':self.__agency, 'agency_id':self.__agency_id,
+                  'generated_time':self.__generated_time.isoformat(), 'reused_report':self.__reused_report,
+                  'counts':counts, 'percentages':percentages, 'timings':dict(self.__timer.timings)}
+        if self.__profile:
+            record['profile'] = dict(self.__timer.profile)
+        if self.__chart_cache_counts is not None:
+            record['chart_cache'] = dict(self.__chart_cache_counts)
+        return record
 
     def generate_trustymail_report(self):
         print('\tparsing data')
-        # build up the report_doc from the query results
-        self.__populate_report_doc()
+        self.score()
+        if self.__low_memory:
+            # only the scores are needed from here on; the CSV attachment
+            # streams the domain documents again
+            self.__base_domains = []
+
+        if self.__incremental and not self.__debug:
+            with self.__timer.stage('reuse'):
+                self.__reused_report = self.__reuse_previous_report()
+            if self.__reused_report:
+                if self.__profile:
+                    self.__report_profile()
+                return self.__results
 
         # create a working directory
         original_working_dir = os.getcwd()
         if self.__debug:
             temp_working_dir = tempfile.mkdtemp(dir=original_working_dir)
+        elif self.__typesetting_dir:
+            # outlives this call; the typesetting pool removes it
+            temp_working_dir = tempfile.mkdtemp(dir=self.__typesetting_dir)
         else:
-            temp_working_dir = tempfile.mkdtemp()
+            temp_working_dir = process_work_dir()
         os.chdir(temp_working_dir)
 
-        # setup the working directory
-        self.__setup_work_directory(temp_working_dir)
-
-        print('\tgenerating attachments')
-        # generate attachments
-        self.__generate_attachments()
-
-        print('\tgenerating charts')
-        # generate charts
-        self.__generate_charts()
-
-        # generate json input to mustache
-        self.__generate_mustache_json(REPORT_JSON)
-
-        # generate latex json + mustache
-        self.__generate_latex(MUSTACHE_FILE, REPORT_JSON, REPORT_TEX)
-
-        print('\tassembling PDF')
-        # generate report figures + latex
-        self.__generate_final_pdf()
-
-        # revert working directory
-        os.chdir(original_working_dir)
+        # always revert the working directory, so that a failed report does
+        # not strand a long-lived batch process in the temporary directory
+        try:
+            # setup the working directory
+            with self.__timer.stage('setup'):
+                self.__setup_work_directory(temp_working_dir)
+
+            print('\tgenerating attachments')
+            # generate attachments
+            with self.__timer.stage('csv'):
+                self.__generate_attachments()
+
+            print('\tgenerating charts')
+            # generate charts
+            with self.__timer.stage('charts'):
+                self.__generate_charts()
+
+            with self.__timer.stage('mustache'):
+                # generate input to mustache
+                mustache_data = self.__generate_mustache_data()
+                if self.__emit_json:
+                    self.__generate_mustache_json(mustache_data, REPORT_JSON)
+
+                # generate latex from mustache data + template
+                self.__generate_latex(mustache_data, REPORT_TEX)
+
+            print('\tassembling PDF')
+            # generate report figures + latex
+            self.__generate_final_pdf(temp_working_dir)
+        finally:
+            # revert working directory
+            os.chdir(original_working_dir)
+
+        if self.__profile:
+            self.__report_profile(temp_working_dir)
 
         # copy report to original working directory
         # and delete working directory
         if not self.__debug:
             src_filename = os.path.join(temp_working_dir, REPORT_PDF)
-            datestamp = self.__generated_time.strftime('%Y-%m-%d')
-            dest_filename = 'cyhy-{}-{}-tmail-report.pdf'.format(self.__agency_id, datestamp)
-            shutil.move(src_filename, dest_filename)
-            src_filename = os.path.join(temp_working_dir, REPORT_JSON)
+            dest_filename = self.__report_filename('pdf')
+            if self.__emit_json:
+                src_filename = os.path.join(temp_working_dir, REPORT_JSON)
+                shutil.move(src_filename, self.__report_filename('json'))
+            manifest_filename = None
+            if self.__incremental:
+                manifest_filename = os.path.abspath(self.__manifest_filename())
+            if self.__typesetting_job:
+                # the typesetting pool moves the PDF and writes the manifest
+                # once the report is typeset
+                self.__typesetting_job.update(pdf_filename=os.path.abspath(dest_filename),
+                                              manifest_filename=manifest_filename,
+                                              manifest=self.__manifest(dest_filename))
+            else:
+                shutil.move(src_filename, dest_filename)
+                if manifest_filename:
+                    write_manifest(manifest_filename, self.__manifest(dest_filename))
         return self.__results
 
+    def score(self):
+        '''Score the report's domains, checking the counts against the
+        vectorized scoring engine if check_scoring, and return the counts.'''
+        # build up the report_doc from the query results
+        with self.__timer.stage('scoring'):
+            self.__populate_report_doc()
+            if self.__score_cache is not None:
+                self.__score_cache.flush()
+        if self.__check_scoring:
+            with self.__timer.stage('check_scoring'):
+                self.__check_score_counts()
+        return dict(self.__score_counts)
+
+    def typesetting_job(self):
+        '''Return the job that typesets the report (see typesetting), if it
+        was left to a typesetting pool, or else None.'''
+        return self.__typesetting_job
+
+    def __report_profile(self, work_dir=None):
+        '''Print the profile of each stage and, in debug mode, also write it to
+        the working directory.'''
+        table = self.__timer.summary_table()
+        print(table)
+        if self.__debug and work_dir is not None:
+            with open(os.path.join(work_dir, REPORT_PROFILE), 'w') as profile_file:
+                profile_file.write(table + '\n')
+
+    def __report_filename(self, extension):
+        datestamp = self.__generated_time.strftime('%Y-%m-%d')
+        return 'cyhy-{}-{}-tmail-report.{}'.format(self.__agency_id, datestamp, extension)
+
+    ###############################################################################
+    #  Incremental Generation
+    ###############################################################################
+    def __manifest_filename(self):
+        return 'cyhy-{}-tmail-report-manifest.json'.format(self.__agency_id)
+
+    def __manifest(self, report_filename):
+        '''Return the manifest recording the fingerprint of the report in
+        report_filename, so that a later run with unchanged inputs can reuse
+        it (see write_manifest).'''
+        return {'fingerprint':self.__fingerprint, 'report':report_filename, 'chart_backend':self.__chart_backend}
+
+    def __reuse_previous_report(self):
+        '''Copy the previously generated report to today's report filename if
+        it was generated from the same inputs.  The copy keeps the report
+        date of the original.  Returns whether the report was reused.'''
+        try:
+            with open(self.__manifest_filename()) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError):
+            return False
+        previous_filename = manifest.get('report')
+        if manifest.get('fingerprint') != self.__fingerprint or not previous_filename or not os.path.exists(previous_filename):
+            return False
+        if manifest.get('chart_backend', 'matplotlib') != self.__chart_backend:
+            return False
+
+        print('\treusing unchanged report {}'.format(previous_filename))
+        dest_filename = self.__report_filename('pdf')
+        if previous_filename != dest_filename:
+            shutil.copyfile(previous_filename, dest_filename)
+        if self.__emit_json:
+            self.__generate_mustache_json(self.__generate_mustache_data(), self.__report_filename('json'))
+        write_manifest(self.__manifest_filename(), self.__manifest(dest_filename))
+        return True
+
     def __setup_work_directory(self, work_dir):
-        me = os.path.realpath(__file__)
-        my_dir = os.path.dirname(me)
-        for n in [MUSTACHE_FILE]:       # add other files as needed
-            file_src = os.path.join(my_dir, n)
-            file_dst = os.path.join(work_dir, n)
-            shutil.copyfile(file_src, file_dst)
-        # copy static assets
-        dir_src = os.path.join(my_dir, ASSETS_DIR_SRC)
-        dir_dst = os.path.join(work_dir, ASSETS_DIR_DST)
-        shutil.copytree(dir_src,dir_dst)
+        setup_work_directory(work_dir)
 
     ###############################################################################
     #  Attachment Generation
     ###############################################################################
     def __generate_attachments(self):
-        self.__generate_trustymail_attachment()
-
-    def __generate_trustymail_attachment(self):
-        header_fields = ('Domain', 'Base Domain', 'Domain Is Base Domain', 'Live', 'MX Record', 'Mail Servers', 'Mail Server Ports Tested', 'Domain Supports SMTP', 'Domain Supports SMTP Results', 'Domain Supports STARTTLS', 'Domain Supports STARTTLS Results', 'SPF Record', 'Valid SPF', 'SPF Results', 'DMARC Record', 'Valid DMARC', 'DMARC Results', 'DMARC Record on Base Domain', 'Valid DMARC Record on Base Domain', 'DMARC Results on Base Domain', 'DMARC Policy', 'DMARC Policy Percentage', 'DMARC Aggregate Report URIs', 'DMARC Forensic Report URIs', 'DMARC Has Aggregate Report URI', 'DMARC Has Forensic Report URI', 'Syntax Errors', 'Debug Info', 'Domain Supports Weak Crypto', 'Mail-Sending Hosts with Weak Crypto')
-        data_fields = ('domain', 'base_domain', 'is_base_domain', 'live', 'mx_record', 'mail_servers', 'mail_server_ports_tested', 'domain_supports_smtp', 'domain_supports_smtp_results', 'domain_supports_starttls', 'domain_supports_starttls_results', 'spf_record', 'valid_spf', 'spf_results', 'dmarc_record', 'valid_dmarc', 'dmarc_results', 'dmarc_record_base_domain', 'valid_dmarc_base_domain', 'dmarc_results_base_domain', 'dmarc_policy', 'dmarc_policy_percentage', 'aggregate_report_uris', 'forensic_report_uris', 'has_aggregate_report_uri', 'has_forensic_report_uri', 'syntax_errors', 'debug_info', 'domain_has_weak_crypto', 'hosts_with_weak_crypto_str')
-        with open(TRUSTYMAIL_RESULTS_CSV_FILE, 'w') as out_file:
-            header_writer = csv.DictWriter(out_file, header_fields, extrasaction='ignore')
+        self.__generate_trustymail_attachment(self.__attachment_domains())
+
+    def __attachment_domains(self):
+        '''Yield all of the agency's domain documents, sorted by domain.'''
+        if not self.__low_memory:
+            domains = self.__all_domains    # sorted by __populate_report_doc
+        elif self.__trustymail_data is not None:
+            domains = sorted(self.__trustymail_data, key=lambda x:x['domain'])
+        elif self.__data_source is not None:
+            domains = self.__data_source.agency_domains(self.__agency)
+        else:
+            domains = find_agency_domains(self.__db, self.__agency).sort('domain', 1)
+        for domain in domains:
+            if self.__check_projection:
+                domain = ProjectedDocument(domain)
+            yield domain
+
+    def __generate_trustymail_attachment(self, domains):
+        '''Write the CSV attachment for the domain documents in the domains
+        iterable, without modifying them.'''
+        with open(TRUSTYMAIL_RESULTS_CSV_FILE, 'w', buffering=TRUSTYMAIL_RESULTS_CSV_BUFFER_SIZE) as out_file:
+            header_writer = csv.DictWriter(out_file, TRUSTYMAIL_RESULTS_CSV_HEADER_FIELDS, extrasaction='ignore')
             header_writer.writeheader()
-            data_writer = csv.DictWriter(out_file, data_fields, extrasaction='ignore')
+            data_writer = csv.DictWriter(out_file, TRUSTYMAIL_RESULTS_CSV_DATA_FIELDS, extrasaction='ignore')
 
             def rehydrate_rua_or_ruf(d):
                 """Reconstitute the rua or ruf string from the
@@ -461,53 +766,40 @@ class ReportGenerator(object):
 
                 return ', '.join(record_list)
 
-            for domain in self.__all_domains:
+            for domain in domains:
+                row = {field:domain[field] for field in TRUSTYMAIL_RESULTS_CSV_DATA_FIELDS if field in domain}
                 ruas = [rehydrate_rua_or_ruf(d) for d in domain['aggregate_report_uris']]
                 rufs = [rehydrate_rua_or_ruf(d) for d in domain['forensic_report_uris']]
-                domain['aggregate_report_uris'] = format_list(ruas)
-                domain['forensic_report_uris'] = format_list(rufs)
-                hosts_with_weak_crypto = [rehydrate_hosts_with_weak_crypto(d) for d in domain['hosts_with_weak_crypto']]
-                domain['hosts_with_weak_crypto_str'] = format_list(hosts_with_weak_crypto)
-                data_writer.writerow(domain)
+                row['aggregate_report_uris'] = format_list(ruas)
+                row['forensic_report_uris'] = format_list(rufs)
+                # streamed documents lack the weak crypto data, so look it up
+                hosts_with_weak_crypto = self.__hosts_with_weak_crypto(domain['domain'])
+                row['domain_has_weak_crypto'] = bool(hosts_with_weak_crypto)
+                row['hosts_with_weak_crypto_str'] = format_list([rehydrate_hosts_with_weak_crypto(d) for d in hosts_with_weak_crypto])
+                data_writer.writerow(row)
 
     ###############################################################################
     #  Chart Generation
     ###############################################################################
     def __generate_charts(self):
-        graphs.setup()
-        self.__generate_dmarc_bar_chart()
-        self.__generate_bod_1801_email_components_bar_chart()
-        self.__generate_donut_charts()
-
-    def __generate_dmarc_bar_chart(self):
-        dmarc_bar = graphs.MyTrustyBar(percentage_list=[self.__valid_dmarc_percentage,
-                                                        self.__valid_dmarc_reject_percentage,
-                                                        self.__valid_dmarc_bod1801_rua_uri_percentage],
-                                       label_list=['Valid\nDMARC',
-                                                   'DMARC\np=reject',
-                                                   'Reports DMARC\nto DHS'],
-                                       fill_color=graphs.DARK_BLUE)
-        dmarc_bar.plot(filename='dmarc-compliance')
-
-    def __generate_bod_1801_email_components_bar_chart(self):
-        bod_1801_email_bar = graphs.MyTrustyBar(percentage_list=[self.__supports_starttls_percentage,
-                                                                 self.__valid_spf_percentage,
-                                                                 self.__has_no_weak_crypto_percentage],
-                                                label_list=['Supports\nSTARTTLS',
-                                                            'Valid\nSPF',
-                                                            'No SSLv2/v3,\n3DES,RC4'],
-                                                fill_color=graphs.DARK_BLUE)
-        bod_1801_email_bar.plot(filename='bod-1801-email-components')
-
-    def __generate_donut_charts(self):
-        bod_1801_compliance_donut = graphs.MyDonutPie(percentage_full=round(self.__bod_1801_compliant_percentage),
-                                                      label='BOD 18-01\nCompliant\n(Email)', fill_color=graphs.DARK_BLUE)
-        bod_1801_compliance_donut.plot(filename='bod-18-01-compliance')
+        if self.__chart_backend == 'tikz':
+            # drawn in the report itself, see __generate_mustache_data
+            chart_engine = graphs.TikzChartEngine()
+        else:
+            chart_engine = graphs.trusty_chart_engine()
+            if self.__chart_cache is not None:
+                chart_engine = CachingChartEngine(chart_engine, self.__chart_cache)
+        plot_score_charts(chart_engine, self.__percentages)
+        chart_engine.flush()
+        if self.__chart_backend == 'tikz':
+            self.__chart_pictures = chart_engine.pictures
+        elif self.__chart_cache is not None:
+            self.__chart_cache_counts = {'hits':chart_engine.hits, 'misses':chart_engine.misses}
 
     ###############################################################################
     # Final Document Generation and Assembly
     ###############################################################################
-    def __generate_mustache_json(self, filename):
+    def __generate_mustache_data(self):
         result = {'report_doc':self.__report_doc}
         result['ineligible_domains'] = self.__ineligible_domains    # NOT CURRENTLY USED?
         result['domain_count'] = int(self.__domain_count)
@@ -537,37 +829,426 @@ class ReportGenerator(object):
         result['supports_starttls_percentage'] = self.__supports_starttls_percentage
         result['bod_1801_compliant_count'] = self.__bod_1801_compliant_count
         result['bod_1801_compliant_percentage'] = self.__bod_1801_compliant_percentage
+        # e.g. dmarc_compliance_tex; the template includes the chart's PDF
+        # instead if it is missing
+        for chart_name, picture in self.__chart_pictures.items():
+            result[chart_name.replace('-', '_') + '_tex'] = picture
 
-        self.__latex_escape_structure(result['report_doc'])
+        return result
 
+    def __generate_mustache_json(self, data, filename):
         with open(filename, 'w') as out:
-            out.write(json.dumps(result))
-
-    def __generate_latex(self, mustache_file, json_file, latex_file):
-        renderer = pystache.Renderer()
-        template = codecs.open(mustache_file,'r', encoding='utf-8').read()
+            json.dump(data, out)
 
-        with codecs.open(json_file,'r', encoding='utf-8') as data_file:
-            data = json.load(data_file)
-
-        r = pystache.render(template, data)
+    def __generate_latex(self, data, latex_file):
+        renderer, template = report_template()
+        r = renderer.render(template, data)
         with codecs.open(latex_file,'w', encoding='utf-8') as output:
             output.write(r)
 
-    def __generate_final_pdf(self):
-        if self.__debug:
-            output = sys.stdout
+    def __generate_final_pdf(self, work_dir):
+        with open(os.devnull, 'w') as devnull:
+            output = sys.stdout if self.__debug else devnull
+            with self.__timer.stage('latex_format'):
+                latex_format = self.__latex_format(output)
+            if self.__typesetting_dir and not self.__debug:
+                # the rest of generate_trustymail_report adds the pdf_filename
+                self.__typesetting_job = {'agency':self.__agency, 'work_dir':work_dir, 'latex_format':latex_format,
+                                          'max_latex_passes':self.__max_latex_passes}
+                return
+
+            references = typeset_latex(latex_format, self.__max_latex_passes, output, _previous_latex_references,
+                                       self.__timer)
+        _previous_latex_references.clear()
+        _previous_latex_references.update(references)
+
+    def __latex_format(self, output):
+        '''Return the path (without extension) of the precompiled format for
+        this report's preamble, dumping it first if needed, or None if no
+        format can be used.'''
+        if not self.__latex_format_dir:
+            return None
+
+        with codecs.open(REPORT_TEX, 'r', encoding='utf-8') as tex_file:
+            preamble, end_of_dump, _ = tex_file.read().partition(LATEX_END_OF_DUMP)
+        if not end_of_dump:
+            return None
+
+        # The preamble includes the report date, so a new format is dumped
+        # whenever the date (or anything else in the preamble) changes
+        format_name = LATEX_FORMAT_PREFIX + hashlib.sha1(preamble.encode('utf-8')).hexdigest()
+        format_path = os.path.join(os.path.abspath(self.__latex_format_dir), format_name)
+        if os.path.exists(format_path + '.fmt'):
+            return format_path
+        if format_path in _failed_latex_formats:
+            return None
+        if dump_latex_format(REPORT_TEX, format_path, output):
+            return format_path
+        _failed_latex_formats.add(format_path)
+        return None
+
+def plot_score_charts(chart_engine, percentages):
+    '''Plot the charts of the agency reports and the federal summary with
+    chart_engine (see graphs.TrustyChartEngine), given their percentages
+    keyed like percentages.score_percentages.'''
+    dmarc_bar = graphs.MyTrustyBar(percentage_list=[percentages['valid_dmarc'],
+                                                    percentages['valid_dmarc_reject'],
+                                                    percentages['valid_dmarc_bod1801_rua_uri']],
+                                   label_list=['Valid\nDMARC',
+                                               'DMARC\np=reject',
+                                               'Reports DMARC\nto DHS'],
+                                   fill_color=graphs.DARK_BLUE)
+    chart_engine.plot(dmarc_bar, 'dmarc-compliance')
+    bod_1801_email_bar = graphs.MyTrustyBar(percentage_list=[percentages['supports_starttls'],
+                                                             percentages['valid_spf'],
+                                                             percentages['has_no_weak_crypto']],
+                                            label_list=['Supports\nSTARTTLS',
+                                                        'Valid\nSPF',
+                                                        'No SSLv2/v3,\n3DES,RC4'],
+                                            fill_color=graphs.DARK_BLUE)
+    chart_engine.plot(bod_1801_email_bar, 'bod-1801-email-components')
+    bod_1801_compliance_donut = graphs.MyDonutPie(percentage_full=round(percentages['bod_1801_compliant']),
+                                                  label='BOD 18-01\nCompliant\n(Email)', fill_color=graphs.DARK_BLUE)
+    chart_engine.plot(bod_1801_compliance_donut, 'bod-18-01-compliance')
+
+# precompiled LaTeX formats that could not be dumped by this process
+_failed_latex_formats = set()
+# cross-reference files of the last report typeset by this process
+_previous_latex_references = dict()
+
+# hash of REPORT_CODE_FILES and REPORT_INPUT_DIRS, computed once per process
+_report_inputs_fingerprint = None
+
+def report_inputs_fingerprint():
+    '''Return a hash of everything besides its data that a report's output
+    depends on: the code, the mustache template, the static assets and fonts
+    and the style version of the charts.'''
+    global _report_inputs_fingerprint
+    if _report_inputs_fingerprint is None:
+        my_dir = os.path.dirname(os.path.realpath(__file__))
+        filenames = [os.path.join(my_dir, n) for n in REPORT_CODE_FILES]
+        for input_dir in REPORT_INPUT_DIRS:
+            for dir_path, dir_names, file_names in os.walk(os.path.join(my_dir, input_dir)):
+                dir_names.sort()
+                filenames.extend(os.path.join(dir_path, n) for n in sorted(file_names))
+        digest = hashlib.sha256('graphs style version {}'.format(graphs.STYLE_VERSION).encode('utf-8'))
+        for filename in filenames:
+            digest.update(os.path.relpath(filename, my_dir).encode('utf-8'))
+            with open(filename, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        _report_inputs_fingerprint = digest.hexdigest()
+    return _report_inputs_fingerprint
+
+def agency_data_fingerprint(agency_data):
+    '''Return a hash of an agency data slice (see new_agency_data) and of
+    report_inputs_fingerprint().  The hash does not depend on the order in
+    which the documents were fetched.'''
+    def documents_digest(docs):
+        # a new scan of a domain does not change the report unless the results do
+        serialized_docs = sorted(json.dumps({k:v for k, v in d.items() if k != 'scan_date'}, sort_keys=True, default=str)
+                                 for d in docs)
+        return hashlib.sha256('\n'.join(serialized_docs).encode('utf-8')).hexdigest()
+
+    digest = hashlib.sha256(report_inputs_fingerprint().encode('utf-8'))
+    digest.update(documents_digest(agency_data['trustymail']).encode('utf-8'))
+    for base_domain in sorted(agency_data['subdomains']):
+        digest.update(base_domain.encode('utf-8'))
+        digest.update(documents_digest(agency_data['subdomains'][base_domain]).encode('utf-8'))
+    digest.update(documents_digest(agency_data['sslyze_scan']).encode('utf-8'))
+    return digest.hexdigest()
+
+def write_manifest(manifest_filename, manifest):
+    '''Atomically write a report's incremental manifest to manifest_filename.
+    It is only written once the report's PDF is in place.'''
+    temp_filename = '{}.{}'.format(manifest_filename, os.getpid())
+    with open(temp_filename, 'w') as out:
+        json.dump(manifest, out)
+    os.replace(temp_filename, manifest_filename)
+
+# working directory reused by the reports generated in the current process,
+# and the pid of that process (forked workers need their own)
+_work_dir = None
+_work_dir_pid = None
+
+def work_dir_root(min_free_bytes=0):
+    '''Return the directory to create working directories in: a tmpfs with at
+    least min_free_bytes free, if one is available and TMPDIR is not set, or
+    else the temporary directory.'''
+    if 'TMPDIR' not in os.environ:
+        for tmpfs_dir in TMPFS_DIRS:
+            if os.path.isdir(tmpfs_dir) and os.access(tmpfs_dir, os.W_OK | os.X_OK):
+                tmpfs_stat = os.statvfs(tmpfs_dir)
+                if tmpfs_stat.f_bavail * tmpfs_stat.f_frsize >= min_free_bytes:
+                    return tmpfs_dir
+    return tempfile.gettempdir()
+
+def process_work_dir():
+    '''Return the working directory of the current process, creating it on
+    first use.  It is removed when the process exits; directories of
+    processes that did not get to remove theirs are removed by
+    cleanup_stale_work_dirs().'''
+    global _work_dir, _work_dir_pid
+    if _work_dir_pid != os.getpid() or not os.path.isdir(_work_dir):
+        cleanup_stale_work_dirs()
+        _work_dir = tempfile.mkdtemp(prefix='{}{}-'.format(WORK_DIR_PREFIX, os.getpid()), dir=work_dir_root())
+        _work_dir_pid = os.getpid()
+        atexit.register(remove_work_dir, _work_dir, _work_dir_pid)
+    return _work_dir
+
+def remove_work_dir(work_dir, pid):
+    '''Remove work_dir, unless the current process is not the one with pid
+    (a forked child inherits its parent's exit handlers).'''
+    if os.getpid() == pid:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def cleanup_stale_work_dirs():
+    '''Remove the working directories of processes that are no longer
+    running, such as crashed reports or batch workers.'''
+    # directories that need more room than the tmpfs has are on disk
+    work_dirs = set()
+    for root in (work_dir_root(), tempfile.gettempdir()):
+        work_dirs.update(glob.glob(os.path.join(root, WORK_DIR_PREFIX + '*')))
+    for work_dir in sorted(work_dirs):
+        pid = os.path.basename(work_dir)[len(WORK_DIR_PREFIX):].partition('-')[0]
+        if not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            # running, as another user
+            continue
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def setup_work_directory(work_dir):
+    '''Prepare work_dir for a report: remove the files of the report
+    previously generated in it, if any, and link the static assets into it.
+    xelatex only reads the assets, so they are linked instead of copied.'''
+    assets_link = os.path.join(work_dir, ASSETS_DIR_DST)
+    with os.scandir(work_dir) as entries:
+        for entry in entries:
+            if entry.path == assets_link:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+    if not os.path.islink(assets_link):
+        my_dir = os.path.dirname(os.path.realpath(__file__))
+        os.symlink(os.path.normpath(os.path.join(my_dir, ASSETS_DIR_SRC)), assets_link)
+
+# mustache renderer and parsed MUSTACHE_FILE, shared by all reports generated
+# in the current process
+_report_template = None
+
+def report_template():
+    '''Return a (renderer, parsed template) tuple for MUSTACHE_FILE, reading and
+    parsing the template on first use only.'''
+    global _report_template
+    if _report_template is None:
+        my_dir = os.path.dirname(os.path.realpath(__file__))
+        with codecs.open(os.path.join(my_dir, MUSTACHE_FILE), 'r', encoding='utf-8') as mustache_file:
+            template = pystache.parse(mustache_file.read())
+        _report_template = (pystache.Renderer(), template)
+    return _report_template
+
+def typeset_latex(latex_format, max_latex_passes, output, previous_references, timer, work_dir='.',
+                  tex_filename=REPORT_TEX):
+    '''Typeset tex_filename in work_dir into a PDF with xelatex, using the
+    precompiled format latex_format unless it is None.  The first pass starts
+    from the cross-reference files previous_references (see
+    read_latex_references), and passes stop once the references settle.
+    xelatex's output goes to the file output and the seconds of each pass to
+    the StageTimer timer.
+
+    Returns
+    -------
+    dict: The cross-reference files of the last pass.
+    '''
+    jobname = os.path.splitext(tex_filename)[0]
+    xelatex_command = ['xelatex', tex_filename]
+    if latex_format:
+        xelatex_command = ['xelatex', '-fmt=' + latex_format, tex_filename]
+
+    # Start from the previous report's cross-reference files; reports with
+    # the same page structure then settle after a single pass
+    for extension, contents in previous_references.items():
+        with open(os.path.join(work_dir, jobname + extension), 'wb') as reference_file:
+            reference_file.write(contents)
+    previous_references = read_latex_references(work_dir, jobname)
+
+    for latex_pass in range(1, max_latex_passes + 1):
+        with timer.stage('xelatex_pass_{}'.format(latex_pass)):
+            return_code = subprocess.call(xelatex_command, stdout=output, stderr=subprocess.STDOUT, cwd=work_dir)
+            if return_code != 0 and latex_format:
+                # The format may be stale (e.g. TeX was upgraded since it was
+                # dumped), so fall back to a full run.  The format is shared
+                # by all reports, so it is only discarded if the full run
+                # succeeds; otherwise the report itself is at fault.
+                full_command = ['xelatex', tex_filename]
+                return_code = subprocess.call(full_command, stdout=output, stderr=subprocess.STDOUT, cwd=work_dir)
+                if return_code == 0:
+                    discard_latex_format(latex_format)
+                    latex_format = None
+                    xelatex_command = full_command
+        assert return_code == 0, 'xelatex pass %d of %d return code was %s' % (latex_pass, max_latex_passes, return_code)
+
+        # Another pass is only needed if this one changed the references
+        references = read_latex_references(work_dir, jobname)
+        if references == previous_references:
+            break
+        previous_references = references
+    return references
+
+def read_latex_references(work_dir='.', jobname=REPORT_JOBNAME):
+    '''Return the contents of the cross-reference files that xelatex wrote
+    for the job jobname in work_dir, keyed by file extension.'''
+    references = dict()
+    for extension in LATEX_REFERENCE_EXTENSIONS:
+        try:
+            with open(os.path.join(work_dir, jobname + extension), 'rb') as reference_file:
+                references[extension] = reference_file.read()
+        except FileNotFoundError:
+            pass
+    return references
+
+def dump_latex_format(tex_filename, format_path, output):
+    '''Dump the preamble of tex_filename (up to LATEX_END_OF_DUMP) into the
+    format file format_path.fmt using mylatexformat.
+
+    Returns
+    -------
+    bool: True if the format was dumped successfully.
+    '''
+    format_dir, format_name = os.path.split(format_path)
+    os.makedirs(format_dir, exist_ok=True)
+    # Dump under a process-specific name, then rename, so concurrent workers
+    # never load a partially written format
+    jobname = '{}.{}'.format(format_name, os.getpid())
+    return_code = subprocess.call(['xelatex', '-ini', '-jobname=' + jobname, '-output-directory=' + format_dir,
+                                   '&xelatex', 'mylatexformat.ltx', tex_filename], stdout=output, stderr=subprocess.STDOUT)
+    for leftover in glob.glob(os.path.join(format_dir, jobname + '.*')):
+        if leftover.endswith('.fmt') and return_code == 0:
+            os.replace(leftover, format_path + '.fmt')
         else:
-            output = open(os.devnull, 'w')
-
-        return_code = subprocess.call(['xelatex', REPORT_TEX], stdout=output, stderr=subprocess.STDOUT)
-        assert return_code == 0, 'xelatex pass 1 of 2 return code was %s' % return_code
-
-        return_code = subprocess.call(['xelatex', REPORT_TEX], stdout=output, stderr=subprocess.STDOUT)
-        assert return_code == 0, 'xelatex pass 2 of 2 return code was %s' % return_code
-
-# connection to database
-def db_from_config(config_filename):
+            os.remove(leftover)
+    if return_code != 0:
+        return False
+
+    # Prune formats of previous runs (e.g. previous days' report dates)
+    for old_format in glob.glob(os.path.join(format_dir, LATEX_FORMAT_PREFIX + '*.fmt')):
+        if time.time() - os.path.getmtime(old_format) > LATEX_FORMAT_MAX_AGE:
+            discard_latex_format(old_format[:-len('.fmt')])
+    return True
+
+def discard_latex_format(format_path):
+    '''Delete a precompiled format, ignoring one already deleted by another
+    process.'''
+    try:
+        os.remove(format_path + '.fmt')
+    except FileNotFoundError:
+        pass
+
+###############################################################################
+#  Data Retrieval
+###############################################################################
+def new_agency_data():
+    '''Return an empty agency data slice, as consumed by ReportGenerator.
+
+    trustymail: the agency's latest trustymail documents
+    subdomains: the latest non-base-domain trustymail documents of each of the
+                agency's base domains (from any agency), sorted by domain and
+                keyed by base domain
+    sslyze_scan: the agency's latest sslyze_scan documents for SMTP ports
+    '''
+    return {'trustymail':[], 'subdomains':{}, 'sslyze_scan':[]}
+
+def find_agency_domains(db, agency, batch_size=0):
+    '''Return a cursor over an agency's latest trustymail documents.  A
+    batch_size of 0 leaves the number of documents per round trip to the
+    server.'''
+    return db.trustymail.find({'latest':True, 'agency.name':agency}, TRUSTYMAIL_PROJECTION, batch_size=batch_size)
+
+def fetch_agency_data(db, agency, batch_size=0):
+    '''Fetch the data slice for a single agency from the database.'''
+    agency_data = new_agency_data()
+    agency_data['trustymail'] = list(find_agency_domains(db, agency, batch_size))
+
+    # Fetch the subdomains of this agency's base domains that belong to other
+    # agencies in a single query, rather than querying once per base domain
+    base_domains = [d['base_domain'] for d in agency_data['trustymail'] if d['is_base_domain']]
+    other_subdomains = list()
+    if base_domains:
+        other_subdomains = db.trustymail.find({'latest':True, 'base_domain':{'$in':base_domains}, 'is_base_domain':False, 'agency.name':{'$ne':agency}}, TRUSTYMAIL_PROJECTION, batch_size=batch_size)
+    add_agency_subdomains(agency_data, other_subdomains)
+    agency_data['sslyze_scan'] = list(db.sslyze_scan.find({'latest':True, 'agency.name':agency, 'scanned_port':{'$in':SSLYZE_SMTP_PORTS}}, SSLYZE_PROJECTION, batch_size=batch_size))
+    return agency_data
+
+def add_agency_subdomains(agency_data, other_subdomains):
+    '''Fill in agency_data['subdomains'] from the subdomains in
+    agency_data['trustymail'] and other_subdomains, the subdomains of the
+    agency's base domains that belong to other agencies.'''
+    subdomains_by_base_domain = dict()
+    base_domains = list()
+    for domain_doc in agency_data['trustymail']:
+        if domain_doc['is_base_domain']:
+            base_domains.append(domain_doc['base_domain'])
+        else:
+            subdomains_by_base_domain.setdefault(domain_doc['base_domain'], []).append(domain_doc)
+    for domain_doc in other_subdomains:
+        subdomains_by_base_domain.setdefault(domain_doc['base_domain'], []).append(domain_doc)
+
+    for base_domain in base_domains:
+        # ReportGenerator adds its weak crypto data to these, so use copies
+        # that are distinct from the documents in agency_data['trustymail']
+        subdomains = subdomains_by_base_domain.get(base_domain, [])
+        agency_data['subdomains'][base_domain] = sorted((dict(d) for d in subdomains), key=lambda x:x['domain'])
+
+def fetch_all_agency_data(db, batch_size=0):
+    '''Fetch the data slices for every agency from the database.
+
+    Every latest trustymail and sslyze_scan document is streamed once and
+    partitioned by agency name in memory, instead of querying the database
+    once (or more) per agency.
+
+    Returns
+    -------
+    dict: Agency data slices (see new_agency_data) keyed by agency name.
+    '''
+    all_agency_data = dict()
+    subdomains_by_base_domain = dict()
+    for domain_doc in db.trustymail.find({'latest':True}, TRUSTYMAIL_PROJECTION, batch_size=batch_size):
+        agency_data = all_agency_data.setdefault(domain_doc['agency']['name'], new_agency_data())
+        agency_data['trustymail'].append(domain_doc)
+        if not domain_doc['is_base_domain']:
+            subdomains_by_base_domain.setdefault(domain_doc['base_domain'], []).append(domain_doc)
+
+    for host in db.sslyze_scan.find({'latest':True, 'scanned_port':{'$in':SSLYZE_SMTP_PORTS}}, SSLYZE_PROJECTION, batch_size=batch_size):
+        agency_data = all_agency_data.setdefault(host['agency']['name'], new_agency_data())
+        agency_data['sslyze_scan'].append(host)
+
+    for agency_data in all_agency_data.values():
+        for domain_doc in agency_data['trustymail']:
+            if domain_doc['is_base_domain']:
+                # Subdomains may belong to another agency, so give each agency
+                # its own copies; ReportGenerator adds its weak crypto data to them
+                subdomains = subdomains_by_base_domain.get(domain_doc['base_domain'], [])
+                agency_data['subdomains'][domain_doc['base_domain']] = sorted((dict(d) for d in subdomains), key=lambda x:x['domain'])
+    return all_agency_data
+
+def max_latex_passes_option(value):
+    '''Return the value of the --max-latex-passes option as an int; fail
+    with the usage message unless it is at least 1.'''
+    max_latex_passes = int(value)
+    if max_latex_passes < 1:
+        raise DocoptExit('--max-latex-passes must be at least 1, not {}'.format(value))
+    return max_latex_passes
+
+# connection to database; client_options are passed to MongoClient, e.g. to
+# size its connection pool
+def db_from_config(config_filename, **client_options):
     with open(config_filename, 'r') as stream:
         config = yaml.load(stream)
 
@@ -577,18 +1258,36 @@ def db_from_config(config_filename):
     except:
         print('Incorrect database config file format: {}'.format(config_filename))
 
-    db_connection = MongoClient(host=db_uri, tz_aware=True)
+    db_connection = MongoClient(host=db_uri, tz_aware=True, **client_options)
     db = db_connection[db_name]
     return db
 
 def main():
     args = docopt(__doc__, version='v0.0.1')
+    max_latex_passes = max_latex_passes_option(args['--max-latex-passes'])
     db = db_from_config(DB_CONFIG_FILE)
+    score_cache = None
+    if args['--score-cache']:
+        score_cache = ScoreCache(args['--score-cache'], int(args['--score-cache-size']))
+    chart_cache = None
+    if args['--chart-cache']:
+        chart_cache = ChartCache(args['--chart-cache'], int(args['--chart-cache-size']) * 1024 * 1024)
 
     print('Generating Trustymail Report...')
     # TODO: Use agency ID instead of full agency name
-    generator = ReportGenerator(db, args['"AGENCY"'], debug=args['--debug'])
+    generator = ReportGenerator(db, args['"AGENCY"'], debug=args['--debug'], check_projection=args['--check-projection'],
+                                latex_format_dir=args['--latex-format-dir'], max_latex_passes=max_latex_passes,
+                                emit_json=args['--emit-json'], low_memory=args['--low-memory'],
+                                incremental=args['--incremental'], score_cache=score_cache,
+                                check_scoring=args['--check-scoring'],
+                                profile=args['--profile'], profile_dir=args['--profile-dir'],
+                                profile_memory=args['--profile-memory'],
+                                chart_backend=args['--chart-backend'], chart_cache=chart_cache)
     results = generator.generate_trustymail_report()
+    if args['--metrics']:
+        metrics_sink = MetricsSink(args['--metrics'])
+        metrics_sink.write(generator.metrics())
+        metrics_sink.close()
     print('Done')
     sys.exit(0)
 
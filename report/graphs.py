@@ -1,20 +1,19 @@
 #!/usr/bin/env python
 
+import io
 import math
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import matplotlib as mpl
-from mpl_toolkits.basemap import Basemap
-from matplotlib.patches import Rectangle, Ellipse, RegularPolygon
-from matplotlib.collections import PatchCollection
+from matplotlib.backends.backend_pdf import FigureCanvasPdf
+from matplotlib.figure import Figure
+from matplotlib.patches import Circle, Rectangle, Ellipse, RegularPolygon
 from matplotlib.ticker import MaxNLocator
-from matplotlib.dates import DateFormatter
 from textwrap import TextWrapper
-from pandas import DataFrame, Series
-import pandas as pd
-from itertools import chain
+# pyplot, Basemap and the other modules that only some of the charts need are
+# imported by those charts, so that importing this module stays fast for the
+# reports, whose charts (see TrustyChartEngine) need none of them
 
 # Blue, Green, Yellow, Orange, Red,
 BLUE = '#5c90ba'
@@ -46,6 +45,10 @@ PIE_COLORS = COLORS + COLORS_DARK + COLORS_LIGHT
 
 TOO_SMALL_WEDGE = 30
 
+# Bump whenever the look of the charts changes, so that charts rendered
+# before are not reused (see chart_cache)
+STYLE_VERSION = 1
+
 # import IPython; IPython.embed() #<<<<<BREAKPOINT>>>>>>>
 
 
@@ -67,7 +70,7 @@ def setup():
               'font.size': 10,
               'text.usetex': False,
               'figure.figsize': fig_size}
-    plt.rcParams.update(params)
+    mpl.rcParams.update(params)
 
 
 def wrapLabels(labels, width):
@@ -83,6 +86,7 @@ class MyMessage(object):
         self.message = message
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         fig = plt.figure(1)
         fig.set_size_inches(fig.get_size_inches() * size)
         ax = fig.add_subplot(1, 1, 1)
@@ -108,6 +112,7 @@ class MyStackedBar(object):
         self.dataLabels = dataLabels
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         pos = np.arange(len(self.ylabels))[::-1]
         fig = plt.figure(1)
         fig.set_size_inches(fig.get_size_inches() * size)
@@ -176,6 +181,7 @@ class MyBar(object):
         self.legendLabels = legendLabels
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         fig = plt.figure(1)
         fig.set_size_inches(fig.get_size_inches() * size)
 
@@ -265,6 +271,7 @@ class MyDistributionBar(object):
         self.x_limit_extra = x_limit_extra  # Used to add a little extra space to the end of the x axis to make the final bucket more readable
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         fig = plt.figure(figsize=(8, 2.75))
         fig.set_size_inches(fig.get_size_inches() * size)
         ax = fig.add_subplot(1, 1, 1)
@@ -390,6 +397,7 @@ class MyPie(object):
                             )
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         (w, h) = plt.rcParams['figure.figsize']
         fig = plt.figure(1)
         fig.set_size_inches(fig.get_size_inches() * size)
@@ -435,6 +443,7 @@ class MyColorBar(object):
         self.label = label
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         cmap = mpl.cm.RdYlGn_r
         norm = mpl.colors.Normalize(vmin=0, vmax=10)
         fig = plt.figure(figsize=(8, 2))
@@ -512,8 +521,10 @@ class MyMap(object):
         self.ll_lon, self.ll_lat, self.ur_lon, self.ur_lat = ll_lon, ll_lat, ur_lon, ur_lat
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         fig = plt.figure(1)
         fig.set_size_inches(fig.get_size_inches() * size)
+        from mpl_toolkits.basemap import Basemap   # loads its map data on import
         mapp = Basemap(projection='merc',
                        resolution='l',  # area_thresh = 0.1,
                        llcrnrlon=self.ll_lon, llcrnrlat=self.ll_lat,
@@ -542,6 +553,7 @@ class MyLine(object):
         self.ylabel = ylabel
 
     def plot(self, filename, size=1.0, figsize=None):
+        import matplotlib.pyplot as plt
         if figsize:
             fig = plt.figure(figsize=figsize)
         else:
@@ -571,6 +583,7 @@ class MyPentaLine(object):
         self.df = data_frame
 
     def plot_four(self, axis, column, color1, color2, last=False, tick_right=False):
+        import matplotlib.pyplot as plt
         axis.text(0.025, 0.75, column.title(), fontsize='small',
                   horizontalalignment='left',
                   transform=axis.transAxes)
@@ -591,6 +604,7 @@ class MyPentaLine(object):
             axis.xaxis.set_visible(False)  # kinda: lost upper ticks
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         df = self.df
         # Three subplots sharing both x/y axes
         fig, axes = plt.subplots(nrows=5, ncols=1, sharex=True, sharey=True)
@@ -633,6 +647,7 @@ class MyStackedLine(object):
 
     def plot(self, filename, size=1.0):
         # TODO Interpolate this data to get a nicer curve
+        import matplotlib.pyplot as plt
         df = self.df
         fig, axes = plt.subplots(figsize=(8, 2.75))
         fig.set_size_inches(fig.get_size_inches() * size)
@@ -642,6 +657,7 @@ class MyStackedLine(object):
         axes.yaxis.tick_left()  # ticks only on left
         axes.yaxis.grid(True)
         axes.xaxis.tick_bottom()  # ticks only on bottom
+        from matplotlib.dates import DateFormatter
         axes.xaxis.set_major_formatter(DateFormatter('%Y-%m-%d'))
         axes.set_axisbelow(True)
         axes.spines['top'].set_visible(False)
@@ -675,6 +691,7 @@ class Boxes(object):
         self.cols = max(self.min_cols, math.ceil(w / cell_size_in) + 1)
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         fig = plt.figure(1)
         fig.set_size_inches(fig.get_size_inches() * size)
         self._calculate_cols(fig)
@@ -720,6 +737,7 @@ class Boxes(object):
                         i = 0
                         j += 1
 
+        from matplotlib.collections import PatchCollection
         patches = PatchCollection(boxes, facecolors=facecolors, edgecolors='white')
         ax.add_collection(patches)
         fig.set_tight_layout(True)
@@ -734,6 +752,7 @@ class Histogram(object):
         self.highlight_bin = highlight_bin
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         fig = plt.figure(1)
         fig.set_size_inches(fig.get_size_inches() * size)
 
@@ -783,6 +802,7 @@ class Histogram2(object):
         self.y_label = y_label
 
     def plot(self, filename, size=1.0):
+        import matplotlib.pyplot as plt
         fig = plt.figure(figsize=(8, 2.5))
         fig.set_size_inches(fig.get_size_inches() * size)
 
@@ -824,6 +844,7 @@ class MyTrustyBar(object):
         self.fill_color = fill_color
 
     def plot(self, filename):
+        import matplotlib.pyplot as plt
         x_left_indices = np.arange(len(self.percentage_list))    # the x locations for the groups
         width = 0.5       # the width of the bars: can also be len(x) sequence
 
@@ -855,6 +876,7 @@ class MyDonutPie(object):
 
     def plot(self, filename, size=1.0):
         # Override default figsize (make square), then scale by size parameter
+        import matplotlib.pyplot as plt
         fig_width = fig_height = 4.0 * size
         plt.rcParams.update({'figure.figsize':[fig_width, fig_height]})
         extent = mpl.transforms.Bbox(((0, 0), (fig_width, fig_height)))  # Minimize whitespace around chart
@@ -886,6 +908,235 @@ class MyDonutPie(object):
         plt.close()
 
 
+class TrustyChartEngine(object):
+    '''Plots MyTrustyBar and MyDonutPie charts into figures that are built
+    once per process and only updated for each chart, instead of building
+    (and tearing down) a new pyplot figure for every chart.  Charts are
+    rendered into in-memory buffers that flush() writes to disk.  The figures
+    are not managed by pyplot, so they never become its current figure.'''
+    def __init__(self):
+        setup()
+        self.__bar_fig_size = list(mpl.rcParams['figure.figsize'])
+        self.__bar_figures = dict()     # keyed on everything but the percentages
+        self.__donut_figures = dict()   # keyed on everything but the percentage
+        self.__buffers = list()         # (filename, buffer) of rendered charts
+
+    def plot(self, chart, filename):
+        buffer = io.BytesIO()
+        if isinstance(chart, MyTrustyBar):
+            self.__plot_bar(chart, buffer)
+        elif isinstance(chart, MyDonutPie):
+            self.__plot_donut(chart, buffer)
+        else:
+            raise TypeError('Unsupported chart type: {}'.format(type(chart).__name__))
+        self.__buffers.append((filename, buffer))
+
+    def flush(self):
+        '''Write all charts plotted since the last flush to disk.'''
+        for filename, buffer in self.__buffers:
+            with open(filename + '.pdf', 'wb') as out:
+                out.write(buffer.getvalue())
+        self.__buffers = list()
+
+    def __plot_bar(self, chart, buffer):
+        key = (len(chart.percentage_list), tuple(chart.label_list), chart.fill_color, chart.title)
+        if key not in self.__bar_figures:
+            self.__bar_figures[key] = self.__create_bar_figure(chart)
+        fig, subplot_params, p1, p2, value_labels = self.__bar_figures[key]
+
+        for bar, white_bar, value_label, percentage in zip(p1, p2, value_labels, chart.percentage_list):
+            bar.set_height(percentage)
+            white_bar.set_y(percentage)
+            white_bar.set_height(100 - percentage)
+            white_bar.sticky_edges.y[:] = [percentage]     # as set by bar(bottom=...)
+            value_label.set_y(1.0 * percentage)
+            value_label.set_text('%d' % int(round(percentage, 0)) + '%')
+
+        ax = fig.axes[0]
+        ax.relim()
+        ax.autoscale_view()
+
+        # tight_layout depends on the current layout (the percentage labels
+        # can stick out of the axes), so always start from the initial one
+        fig.subplots_adjust(**subplot_params)
+        fig.tight_layout(rect=[0, 0, 1, 0.98])  # trims margins down nicely
+        fig.savefig(buffer, format='pdf')
+
+    def __create_bar_figure(self, chart):
+        # Same layout as MyTrustyBar.plot, with placeholder percentages
+        fig = Figure(figsize=self.__bar_fig_size)
+        FigureCanvasPdf(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        x_left_indices = np.arange(len(chart.percentage_list))    # the x locations for the groups
+        width = 0.5       # the width of the bars: can also be len(x) sequence
+        zeros = [0] * len(chart.percentage_list)
+
+        p1 = ax.bar(x_left_indices, zeros, width, color=chart.fill_color, edgecolor='none')
+        p2 = ax.bar(x_left_indices, [100] * len(zeros), width, color='w', bottom=zeros, edgecolor='none')
+
+        ax.set_ylabel('Percent (%)', fontsize=14, style='italic')
+        if chart.title:
+            ax.set_title(chart.title, fontsize=20, fontweight='bold', y=1.07)
+        ax.set_xticks(x_left_indices)
+        ax.set_xticklabels(chart.label_list, fontsize=14, style='italic')
+        ax.set_yticks(np.arange(10, 100, 10))
+        ax.tick_params(axis='y', labelsize=13)
+
+        value_labels = [ax.text(bar.get_x() + bar.get_width()/2.0, 0, '', ha='center', va='bottom', fontsize=15)
+                        for bar in p1]
+        subplot_params = {name:getattr(fig.subplotpars, name) for name in ('left', 'right', 'bottom', 'top')}
+        return fig, subplot_params, p1, p2, value_labels
+
+    def __plot_donut(self, chart, buffer):
+        key = (chart.label, chart.fill_color)
+        if key not in self.__donut_figures:
+            self.__donut_figures[key] = self.__create_donut_figure(chart)
+        fig, subplot_params, wedges, percentage_text = self.__donut_figures[key]
+
+        # The pie starts at 90 degrees and runs counterclockwise: first the
+        # white (empty) wedge, then the filled one; compute the angles the way
+        # pie() does so the output matches MyDonutPie.plot
+        empty_wedge, full_wedge = wedges
+        theta = 90 / 360.0 + (100 - chart.percentage_full) / 100.0
+        empty_wedge.set_theta2(360 * theta)
+        full_wedge.set_theta1(360 * theta)
+        full_wedge.set_theta2(360 * (theta + chart.percentage_full / 100.0))
+        percentage_text.set_text(str(chart.percentage_full) + '%')
+        ax = fig.axes[0]
+        ax.relim()
+        ax.axis('equal')
+
+        fig.subplots_adjust(**subplot_params)
+        fig.tight_layout()  # trims margins down nicely
+        extent = mpl.transforms.Bbox(((0, 0), tuple(fig.get_size_inches())))  # Minimize whitespace around chart
+        fig.savefig(buffer, format='pdf', bbox_inches=extent, pad_inches=0)
+
+    def __create_donut_figure(self, chart, size=1.0):
+        # Same layout as MyDonutPie.plot, with a placeholder percentage
+        fig_width = fig_height = 4.0 * size
+        fig = Figure(figsize=[fig_width, fig_height])
+        FigureCanvasPdf(fig)
+        ax = fig.add_subplot(1, 1, 1)
+
+        # Set edge color to black
+        # See https://matplotlib.org/users/dflt_style_changes.html#patch-edges-and-color
+        with mpl.rc_context({'patch.force_edgecolor':True, 'patch.facecolor':'b'}):
+            wedges, _ = ax.pie([50, 50], labels=('', ''), colors=['white', chart.fill_color], shadow=False, startangle=90)
+
+        # Draw a circle at the center of pie to make it look like a donut
+        centre_circle = Circle((0,0),0.75,color='black', fc='white',linewidth=1.25)
+        ax.add_artist(centre_circle)
+
+        percentage_text = ax.text(0, 0.15, '', horizontalalignment='center', verticalalignment='center', fontsize=50)
+        ax.text(0, -0.3, chart.label, horizontalalignment='center', verticalalignment='center', fontsize=19.5, fontweight='bold')
+
+        # Set aspect ratio to be equal so that pie is drawn as a circle.
+        ax.axis('equal')
+        subplot_params = {name:getattr(fig.subplotpars, name) for name in ('left', 'right', 'bottom', 'top')}
+        return fig, subplot_params, wedges, percentage_text
+
+
+# escapes of the text typeset in the reports (see generate_trustymail_report)
+LATEX_ESCAPE_MAP = {
+    '$':'\\$',
+    '%':'\\%',
+    '&':'\\&',
+    '#':'\\#',
+    '_':'\\_',
+    '{':'\\{',
+    '}':'\\}',
+    '[':'{[}',
+    ']':'{]}',
+    "'":"{'}",
+    '\\':'\\textbackslash{}',
+    '~':'\\textasciitilde{}',
+    '<':'\\textless{}',
+    '>':'\\textgreater{}',
+    '^':'\\textasciicircum{}',
+    '`':'{}`',
+    '\n': '\\newline{}',
+}
+# in a TikZ node with align=center, \\ rather than \newline breaks lines
+TIKZ_ESCAPE_TABLE = str.maketrans(dict(LATEX_ESCAPE_MAP, **{'\n':'\\\\'}))
+
+
+class TikzChartEngine(object):
+    '''Renders MyTrustyBar and MyDonutPie charts as TikZ pictures that are
+    typeset as part of the report, instead of as PDFs that the report
+    includes.  The pictures are drawn with a few TikZ primitives sized like
+    the included PDFs (at scale 0.45), so no matplotlib figure is built at
+    all.  plot() stores each chart's picture in pictures, keyed by the
+    filename it would have been written to.'''
+    def __init__(self):
+        self.pictures = dict()
+
+    def plot(self, chart, filename):
+        if isinstance(chart, MyTrustyBar):
+            self.pictures[filename] = self.__bar_picture(chart)
+        elif isinstance(chart, MyDonutPie):
+            self.pictures[filename] = self.__donut_picture(chart)
+        else:
+            raise TypeError('Unsupported chart type: {}'.format(type(chart).__name__))
+
+    def flush(self):
+        '''Nothing to write; the pictures are typeset with the report.'''
+        pass
+
+    @staticmethod
+    def __color(fill_color):
+        return '{{rgb,255:red,{};green,{};blue,{}}}'.format(*(int(fill_color[i:i + 2], 16) for i in (1, 3, 5)))
+
+    def __bar_picture(self, chart):
+        # one unit per bar, 0-100 percent on the y axis
+        lines = [r'\begin{tikzpicture}[x=2.1cm, y=0.036cm, font=\fontsize{6.5}{7.5}\selectfont]']
+        for i, percentage in enumerate(chart.percentage_list):
+            lines.append(r'\fill[fill={}] ({}, 0) rectangle ({}, {});'.format(self.__color(chart.fill_color),
+                                                                               i + 0.25, i + 0.75, percentage))
+            lines.append(r'\node[above, font=\fontsize{{7}}{{8}}\selectfont] at ({}, {}) {{{}\%}};'.format(
+                i + 0.5, percentage, int(round(percentage, 0))))
+            lines.append(r'\node[below, align=center, font=\itshape] at ({}, 0) {{{}}};'.format(
+                i + 0.5, chart.label_list[i].translate(TIKZ_ESCAPE_TABLE)))
+        lines.append(r'\draw[line width=0.4pt] (0, 0) rectangle ({}, 100);'.format(len(chart.percentage_list)))
+        for tick in range(10, 100, 10):
+            lines.append(r'\draw[line width=0.4pt] (0, {0}) -- ++(-1.5pt, 0) node[left] {{{0}}};'.format(tick))
+        lines.append(r'\node[rotate=90, font=\itshape, anchor=south] at (-0.2, 50) {Percent (\%)};')
+        if chart.title:
+            lines.append(r'\node[above, font=\bfseries\fontsize{{9}}{{11}}\selectfont] at ({}, 107) {{{}}};'.format(
+                len(chart.percentage_list) / 2.0, chart.title.translate(TIKZ_ESCAPE_TABLE)))
+        lines.append(r'\end{tikzpicture}')
+        return '\n'.join(lines)
+
+    def __donut_picture(self, chart):
+        # As with pie(startangle=90): the empty wedge runs counterclockwise
+        # from 90 degrees, then the filled wedge up to 450 degrees
+        lines = [r'\begin{tikzpicture}[x=1.9cm, y=1.9cm, line width=0.45pt]',
+                 r'\filldraw[fill=white] (0, 0) circle (1);']
+        if chart.percentage_full >= 100:
+            lines.append(r'\filldraw[fill={}] (0, 0) circle (1);'.format(self.__color(chart.fill_color)))
+        elif chart.percentage_full > 0:
+            start_angle = 90 + 360 * (100 - chart.percentage_full) / 100.0
+            lines.append(r'\filldraw[fill={}] (0, 0) -- ({}:1) arc ({}:450:1) -- cycle;'.format(
+                self.__color(chart.fill_color), start_angle, start_angle))
+        lines.extend([r'\filldraw[fill=white, line width=0.56pt] (0, 0) circle (0.75);',
+                      r'\node at (0, 0.15) {{\fontsize{{22}}{{24}}\selectfont {}\%}};'.format(chart.percentage_full),
+                      r'\node[align=center, font=\bfseries\fontsize{{9}}{{10}}\selectfont] at (0, -0.3) {{{}}};'.format(
+                          chart.label.translate(TIKZ_ESCAPE_TABLE)),
+                      r'\end{tikzpicture}'])
+        return '\n'.join(lines)
+
+
+# TrustyChartEngine of the current process
+_trusty_chart_engine = None
+
+def trusty_chart_engine():
+    '''Return the TrustyChartEngine of the current process, creating it on
+    first use.'''
+    global _trusty_chart_engine
+    if _trusty_chart_engine is None:
+        _trusty_chart_engine = TrustyChartEngine()
+    return _trusty_chart_engine
+
+
 if __name__ == "__main__":
     setup()
 
@@ -0,0 +1,182 @@
+'''Machine-readable metrics of report generation.
+
+Metrics records are dicts that are appended to a JSON Lines file, one record
+per line, so that a batch's numbers and timings can be collected without
+parsing its output.'''
+
+# standard python libraries
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# third-party libraries (install with pip)
+from pymongo import monitoring
+
+class MetricsSink(object):
+    '''Appends metrics records to a JSON Lines file.  Only one process should
+    write to a sink; batch workers return their records to the parent.'''
+    def __init__(self, filename):
+        self.__file = open(filename, 'a')
+
+    def write(self, record):
+        self.__file.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+        self.__file.flush()
+
+    def close(self):
+        self.__file.close()
+
+class StageTimer(object):
+    '''Accumulates the wall-clock seconds spent in each named stage.'''
+    def __init__(self):
+        self.timings = dict()
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - start_time
+
+class StageProfiler(StageTimer):
+    '''A StageTimer that also records the CPU seconds of each stage (of this
+    process and of the subprocesses it waited for, such as xelatex).  The
+    peak RSS of the process and of its subprocesses so far is recorded too,
+    but as a lifetime high-water mark it only grows from stage to stage.
+
+    If trace_memory, the peak of the memory each stage allocated is traced
+    with tracemalloc.  Tracing every allocation slows the stages down several
+    times over, so the timings of such a run only serve to tell its stages
+    apart; memory and timing figures cannot come from the same run.  If
+    cprofile_dir is given, each stage is also profiled with cProfile and its
+    stats are dumped to <stage>.prof there.'''
+    def __init__(self, cprofile_dir=None, trace_memory=False):
+        super(StageProfiler, self).__init__()
+        self.__trace_memory = trace_memory
+        self.__cprofile_dir = cprofile_dir
+        if cprofile_dir:
+            os.makedirs(cprofile_dir, exist_ok=True)
+        self.profile = dict()   # stage name: dict of measurements
+
+    @contextmanager
+    def stage(self, name):
+        profiler = cProfile.Profile() if self.__cprofile_dir else None
+        start_self = resource.getrusage(resource.RUSAGE_SELF)
+        start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if self.__trace_memory:
+            # tracing only this stage's allocations, its peak is its own
+            tracemalloc.start()
+        try:
+            with super(StageProfiler, self).stage(name):
+                try:
+                    if profiler:
+                        profiler.enable()
+                    yield
+                finally:
+                    if profiler:
+                        profiler.disable()
+        finally:
+            traced_peak = None
+            if self.__trace_memory:
+                _, traced_peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            # a failed stage is recorded too
+            self.__record(name, profiler, start_self, start_children, traced_peak)
+
+    def __record(self, name, profiler, start_self, start_children, traced_peak):
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stage_profile = self.profile.setdefault(name, {'cpu':0.0, 'children_cpu':0.0})
+        stage_profile['wall'] = self.timings[name]
+        stage_profile['cpu'] += (end_self.ru_utime + end_self.ru_stime) - (start_self.ru_utime + start_self.ru_stime)
+        stage_profile['children_cpu'] += ((end_children.ru_utime + end_children.ru_stime) -
+                                          (start_children.ru_utime + start_children.ru_stime))
+        if traced_peak is not None:
+            stage_profile['stage_peak_mb'] = max(stage_profile.get('stage_peak_mb', 0.0), traced_peak / (1024.0 * 1024.0))
+        # ru_maxrss is in kilobytes on Linux
+        stage_profile['lifetime_peak_rss_mb'] = end_self.ru_maxrss / 1024.0
+        stage_profile['children_lifetime_peak_rss_mb'] = end_children.ru_maxrss / 1024.0
+        if profiler:
+            profiler.dump_stats(os.path.join(self.__cprofile_dir, name + '.prof'))
+
+    def summary_table(self):
+        '''Return the measurements of each stage as a text table; the stage
+        peaks are only traced with trace_memory.'''
+        lines = ['{:<16} {:>9} {:>9} {:>13} {:>13} {:>15} {:>21}'.format(
+            'Stage', 'Wall s', 'CPU s', 'Child CPU s', 'Stage Peak MB', 'Lifetime RSS MB', 'Child Lifetime RSS MB')]
+        for name, stage_profile in self.profile.items():
+            stage_peak = stage_profile.get('stage_peak_mb')
+            lines.append('{:<16} {:>9.3f} {:>9.3f} {:>13.3f} {:>13} {:>15.1f} {:>21.1f}'.format(
+                name, stage_profile['wall'], stage_profile['cpu'], stage_profile['children_cpu'],
+                '-' if stage_peak is None else '{:.1f}'.format(stage_peak), stage_profile['lifetime_peak_rss_mb'],
+                stage_profile['children_lifetime_peak_rss_mb']))
+        return '\n'.join(lines)
+
+class ConnectionPoolMetrics(monitoring.ConnectionPoolListener):
+    '''Counts the connections of a MongoClient's pools and how long threads
+    waited to check them out, in order to size its maxPoolSize.  Register it
+    with MongoClient(event_listeners=[...]); it is thread-safe.'''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__checkout_start = threading.local()
+        self.__counts = dict.fromkeys(('connections_created', 'connections_closed', 'checkouts',
+                                       'checkout_failures', 'checkins'), 0)
+        self.__checkout_wait = 0.0
+        self.__max_checkout_wait = 0.0
+
+    def __count(self, name):
+        with self.__lock:
+            self.__counts[name] += 1
+
+    def __checkout_finished(self, name):
+        wait = time.time() - getattr(self.__checkout_start, 'time', time.time())
+        with self.__lock:
+            self.__counts[name] += 1
+            self.__checkout_wait += wait
+            self.__max_checkout_wait = max(self.__max_checkout_wait, wait)
+
+    def record(self):
+        '''Return the counts and checkout wait times so far, as a dict.'''
+        with self.__lock:
+            record = dict(self.__counts)
+            record['checkout_wait_seconds'] = self.__checkout_wait
+            record['max_checkout_wait_seconds'] = self.__max_checkout_wait
+        return record
+
+    def connection_check_out_started(self, event):
+        self.__checkout_start.time = time.time()
+
+    def connection_checked_out(self, event):
+        self.__checkout_finished('checkouts')
+
+    def connection_check_out_failed(self, event):
+        self.__checkout_finished('checkout_failures')
+
+    def connection_checked_in(self, event):
+        self.__count('checkins')
+
+    def connection_created(self, event):
+        self.__count('connections_created')
+
+    def connection_closed(self, event):
+        self.__count('connections_closed')
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
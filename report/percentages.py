@@ -0,0 +1,23 @@
+'''Percentages of the report's counts, shared by the agency reports and the
+federal summary.
+
+Kept apart from vectorized_scoring so that generating an agency report does
+not import pandas.'''
+
+# the count each percentage in the report is relative to
+PERCENTAGE_DENOMINATORS = {
+    'valid_dmarc': 'all_eligible_domains',
+    'valid_dmarc_reject': 'all_eligible_domains',
+    'valid_dmarc_bod1801_rua_uri': 'all_eligible_domains',
+    'supports_starttls': 'base_domain_plus_smtp_subdomain',
+    'valid_spf': 'base_domain_plus_smtp_subdomain',
+    'has_no_weak_crypto': 'base_domain_plus_smtp_subdomain',
+    'bod_1801_compliant': 'base_domain_plus_smtp_subdomain',
+}
+
+def score_percentages(counts):
+    '''Return the report's percentages for counts, rounded the way the
+    agency reports round them.  A percentage of no domains is 0.0, e.g. for
+    a federal summary that no agency has eligible domains in.'''
+    return {name:round(((counts[name]/float(counts[denominator])) * 100), 1) if counts[denominator] else 0.0
+            for name, denominator in PERCENTAGE_DENOMINATORS.items()}
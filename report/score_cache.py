@@ -0,0 +1,59 @@
+'''Persistent cache of domain scores, shared between report runs and between
+the processes generating reports concurrently.
+
+Entries are stored as JSON in a SQLite database and evicted least recently
+used first once the cache holds more than max_entries of them.'''
+
+# standard python libraries
+import json
+import sqlite3
+import time
+
+SCORE_CACHE_TIMEOUT = 60      # seconds to wait for another process's lock
+
+class ScoreCache(object):
+    def __init__(self, filename, max_entries):
+        self.__max_entries = max_entries
+        self.__connection = sqlite3.connect(filename, timeout=SCORE_CACHE_TIMEOUT)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        with self.__connection:
+            self.__connection.execute('CREATE TABLE IF NOT EXISTS scores '
+                                      '(key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)')
+            self.__connection.execute('CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)')
+        self.__used_keys = set()    # keys read since the last flush
+        self.__new_entries = dict() # entries added since the last flush
+
+    def get(self, key):
+        '''Return the value cached for key, or None.'''
+        if key in self.__new_entries:
+            return json.loads(self.__new_entries[key])
+        row = self.__connection.execute('SELECT value FROM scores WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.__used_keys.add(key)
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        '''Cache value (which must be serializable as JSON) for key.'''
+        self.__new_entries[key] = json.dumps(value)
+
+    def flush(self):
+        '''Write the entries added since the last flush, record which entries
+        were used and evict the least recently used entries.'''
+        now = time.time()
+        with self.__connection:
+            self.__connection.executemany('UPDATE scores SET last_used = ? WHERE key = ?',
+                                          ((now, key) for key in self.__used_keys))
+            self.__connection.executemany('INSERT OR REPLACE INTO scores (key, value, last_used) VALUES (?, ?, ?)',
+                                          ((key, value, now) for key, value in self.__new_entries.items()))
+            entry_count = self.__connection.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+            if entry_count > self.__max_entries:
+                self.__connection.execute('DELETE FROM scores WHERE key IN '
+                                          '(SELECT key FROM scores ORDER BY last_used LIMIT ?)',
+                                          (entry_count - self.__max_entries,))
+        self.__used_keys = set()
+        self.__new_entries = dict()
+
+    def close(self):
+        self.flush()
+        self.__connection.close()
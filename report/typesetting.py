@@ -0,0 +1,102 @@
+'''Typesetting of agency reports in a pool of threads of the batch process.
+
+A ReportGenerator given a typesetting_dir prepares its report in a directory
+there but leaves typesetting it to a TypesettingPool: its typesetting_job()
+is a dict of
+
+  agency: the agency of the report
+  work_dir: the directory of the report's REPORT_TEX and its charts
+  latex_format: the precompiled LaTeX format to typeset with, or None
+  max_latex_passes: the maximum number of xelatex passes
+  pdf_filename: the absolute path to move the typeset PDF to
+  manifest_filename: the absolute path of the report's incremental manifest,
+    or None unless the batch is incremental
+  manifest: the manifest to write there once the PDF is in place
+
+The pool only overlaps typesetting with generation: the next reports are
+generated while earlier ones are typeset.  Each job still runs its xelatex
+passes as subprocesses, so engine start-up and font loading are not saved;
+a precompiled format (--latex-format-dir) is what cuts those.  Each job is
+typeset in its own directory, and a job that fails does not affect the
+others.
+
+Reports are generated faster than they are typeset, so submit() blocks
+while max_pending jobs are waiting or being typeset.  Their directories are
+only spooled on a tmpfs if it has room for that many of them (see
+TYPESETTING_JOB_BYTES).'''
+
+# standard python libraries
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# intra-project modules
+from generate_trustymail_report import REPORT_PDF, WORK_DIR_PREFIX, typeset_latex, work_dir_root, write_manifest
+from metrics import StageTimer
+
+# generous estimate of the size of a job's directory (its TeX source, charts
+# and CSV attachment), used to decide whether the spool fits on a tmpfs
+TYPESETTING_JOB_BYTES = 32 * 1024 * 1024
+
+class TypesettingPool(object):
+    '''Typesets the jobs submitted to it in a pool of worker threads, with up
+    to max_pending (by default twice as many) jobs submitted at once.  Jobs
+    are prepared in spool_dir, which is removed when the pool is closed; it
+    is named like a working directory of this process, so that it is also
+    removed if the process crashes (see cleanup_stale_work_dirs).'''
+    def __init__(self, workers, max_pending=None):
+        max_pending = max_pending or 2 * workers
+        self.spool_dir = tempfile.mkdtemp(prefix='{}{}-'.format(WORK_DIR_PREFIX, os.getpid()),
+                                          dir=work_dir_root(max_pending * TYPESETTING_JOB_BYTES))
+        # the executor's queue holds the jobs waiting for a worker
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__pending = threading.BoundedSemaphore(max_pending)
+        # cross-reference files of the last report typeset by the pool
+        self.__references_lock = threading.Lock()
+        self.__previous_references = dict()
+
+    def submit(self, job):
+        '''Queue job (see typesetting) and return a Future of its outcome, a
+        dict of its status ('success' or 'failure'), error, seconds and
+        xelatex pass timings.  The Future never raises.  Blocks while
+        max_pending jobs are pending.'''
+        self.__pending.acquire()
+        future = self.__executor.submit(self.__typeset, job)
+        future.add_done_callback(lambda _:self.__pending.release())
+        return future
+
+    def close(self):
+        '''Typeset the jobs that are still queued, then stop the workers and
+        remove spool_dir.'''
+        self.__executor.shutdown(wait=True)
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def __typeset(self, job):
+        print('Typesetting Trustymail Report for {}...'.format(job['agency']))
+        start_time = time.time()
+        timer = StageTimer()
+        status = 'success'
+        error = ''
+        with self.__references_lock:
+            previous_references = dict(self.__previous_references)
+        try:
+            with open(os.devnull, 'w') as output:
+                references = typeset_latex(job['latex_format'], job['max_latex_passes'], output, previous_references,
+                                           timer, job['work_dir'])
+            shutil.move(os.path.join(job['work_dir'], REPORT_PDF), job['pdf_filename'])
+            # only a report that was typeset may be reused by a later run
+            if job['manifest_filename']:
+                write_manifest(job['manifest_filename'], job['manifest'])
+            with self.__references_lock:
+                self.__previous_references = references
+        except Exception as e:
+            status = 'failure'
+            error = '{}: {}'.format(type(e).__name__, e)
+            traceback.print_exc()
+        finally:
+            shutil.rmtree(job['work_dir'], ignore_errors=True)
+        return {'status':status, 'error':error, 'seconds':time.time() - start_time, 'timings':timer.timings}
@@ -0,0 +1,99 @@
+'''Columnar alternative to ReportGenerator's recursive domain scoring.
+
+The domains an agency report scores are loaded into a pandas DataFrame with
+one boolean column per trustymail attribute the counts depend on, so that all
+of the report's counts are computed with boolean masks in a single pass.
+Frames for many agencies can be concatenated to compute rollups over all of
+their domains at once.'''
+
+# third-party libraries (install with pip)
+import numpy as np
+import pandas as pd
+
+# trustymail fields needed to group documents into base domains with their
+# subdomains and build a domain_frame from them; the weak crypto data is added
+# to the documents separately
+DOMAIN_FRAME_FIELDS = ('agency', 'domain', 'base_domain', 'is_base_domain', 'live', 'mx_record', 'domain_supports_smtp', 'domain_supports_starttls', 'valid_spf', 'valid_dmarc', 'valid_dmarc_base_domain', 'dmarc_policy', 'aggregate_report_uris')
+
+def domain_frame(base_domains, bod1801_dmarc_rua_uri):
+    '''Return a DataFrame with a row for every domain that scoring base_domains
+    (with their subdomains) visits, in the order they are visited.
+
+    Parameters
+    ----------
+    base_domains : list
+        Base domain documents, each with its subdomain documents in
+        'subdomains' and the weak crypto data added by ReportGenerator.
+    bod1801_dmarc_rua_uri : str
+        The DMARC aggregate report URI required by BOD 18-01.
+    '''
+    rows = list()   # (document, whether its base domain is live, agency)
+    for base_domain in base_domains:
+        # the agency whose report scores a domain is its base domain's
+        agency = base_domain['agency']['name']
+        rows.append((base_domain, True, agency))
+        for subdomain in base_domain.get('subdomains') or []:
+            rows.append((subdomain, bool(base_domain['live']), agency))
+
+    def column(values):
+        return np.fromiter(values, dtype=bool, count=len(rows))
+
+    return pd.DataFrame({
+        'agency': [agency for _, _, agency in rows],
+        'domain': [d['domain'] for d, _, _ in rows],
+        'is_base_domain': column(bool(d['is_base_domain']) for d, _, _ in rows),
+        'live': column(bool(d['live']) for d, _, _ in rows),
+        'parent_live': column(parent_live for _, parent_live, _ in rows),
+        'mx_record': column(bool(d['mx_record']) for d, _, _ in rows),
+        'domain_supports_smtp': column(bool(d['domain_supports_smtp']) for d, _, _ in rows),
+        'domain_supports_starttls': column(bool(d['domain_supports_starttls']) for d, _, _ in rows),
+        'valid_spf': column(bool(d['valid_spf']) for d, _, _ in rows),
+        'valid_dmarc': column(bool(d['valid_dmarc'] or d['valid_dmarc_base_domain']) for d, _, _ in rows),
+        'dmarc_policy_reject': column(d['dmarc_policy'] == 'reject' for d, _, _ in rows),
+        'has_bod1801_rua_uri': column(any(uri['uri'] == bod1801_dmarc_rua_uri for uri in d['aggregate_report_uris'])
+                                      for d, _, _ in rows),
+        'domain_has_weak_crypto': column(bool(d['domain_has_weak_crypto']) for d, _, _ in rows),
+    })
+
+def score_masks(frame):
+    '''Return a DataFrame with a boolean column for each of the report's
+    counts (named like SCORE_COUNTS in generate_trustymail_report) that is
+    true for the domains in frame that the count includes.'''
+    # Live base domains are always scored; live subdomains only if their base
+    # domain is live or they support SMTP
+    scored = frame['live'] & (frame['is_base_domain'] | frame['parent_live'] | frame['domain_supports_smtp'])
+    valid_dmarc = scored & frame['valid_dmarc']
+    valid_dmarc_reject = valid_dmarc & frame['dmarc_policy_reject']
+    valid_dmarc_bod1801_rua_uri = valid_dmarc & frame['has_bod1801_rua_uri']
+    # For SPF, STARTTLS, Weak Crypto and BOD 18-01 Compliance, only base
+    # domains and subdomains that support SMTP count
+    smtp_counted = scored & (frame['is_base_domain'] | frame['domain_supports_smtp'])
+    supports_starttls = smtp_counted & (frame['domain_supports_starttls'] | ~frame['domain_supports_smtp'])
+    bod_1801_compliant = (supports_starttls & frame['valid_spf'] & ~frame['domain_has_weak_crypto'] &
+                          valid_dmarc_reject & valid_dmarc_bod1801_rua_uri)
+
+    return pd.DataFrame({
+        'eligible_domains': scored & frame['is_base_domain'],
+        'all_eligible_domains': scored,
+        'base_domain_supports_smtp': scored & frame['is_base_domain'] & frame['domain_supports_smtp'],
+        'eligible_subdomains': scored & ~frame['is_base_domain'],
+        'valid_dmarc': valid_dmarc,
+        'valid_dmarc_reject': valid_dmarc_reject,
+        'valid_dmarc_bod1801_rua_uri': valid_dmarc_bod1801_rua_uri,
+        'mx_record': scored & frame['mx_record'],
+        'domain_supports_smtp': scored & frame['domain_supports_smtp'],
+        'base_domain_plus_smtp_subdomain': smtp_counted,
+        'valid_spf': smtp_counted & frame['valid_spf'],
+        'has_no_weak_crypto': smtp_counted & ~frame['domain_has_weak_crypto'],
+        'supports_starttls': supports_starttls,
+        'bod_1801_compliant': bod_1801_compliant,
+    })
+
+def score_counts(frame):
+    '''Return the report's counts for the domains in frame, as ints.'''
+    return {name:int(count) for name, count in score_masks(frame).sum().items()}
+
+def agency_score_counts(frame):
+    '''Return a DataFrame of the report's counts for each agency in frame,
+    indexed by agency name.'''
+    return score_masks(frame).groupby(frame['agency']).sum()